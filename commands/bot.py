@@ -11,6 +11,11 @@ class Bot:
     _help_messages = {
         'group': 'Bot controls (player modes, status, title, volume)',
 
+        'backup': '* Creates an online backup of the database\n\n'
+        'Database is copied in small steps while the bot keeps running, the playback is not affected. Backups are '
+        'stored in the configured directory and only a configured number of the newest ones is kept. Backups are also '
+        'created periodically if configured so.',
+
         'djmode': '* Switches the player to the DJ mode\n\n'
         'In the DJ mode, users can join a DJ queue and play music from their playlists. Automatic playlist is used '
         'when no DJs are present and someone is listening. Listeners can vote to skip songs played.',
@@ -23,6 +28,12 @@ class Bot:
         'Please note that you\'ll need an access to the server to re-launch the bot. Good for doing a maintenance, '
         'for example updating the bot or changing bot\'s configuration.',
 
+        'stats': '* Displays internal runtime statistics\n\n'
+        'Statistics are meant as an aid for the bot operators when investigating performance issues. Database worker '
+        'queue depth and latencies of the recent database jobs (including the time spent in the queue) are listed, as '
+        'well as the state of the read-only connection pool, the progress of the background song validation and the '
+        'extractor cache hit rates.',
+
         'status': 'Reprints the status message\n\n'
         'Reprints the status message if it has been pushed up by other messages.',
 
@@ -50,6 +61,13 @@ class Bot:
                                  'available subcommands.'
                                  .format(subcommand, self._bot.config['ddmbot']['delimiter']))
 
+    @privileged
+    @bot.command(ignore_extra=False, help=_help_messages['backup'])
+    async def backup(self):
+        await self._bot.whisper('Creating the database backup, this may take a while...')
+        filename, elapsed = await self._bot.database.backup()
+        await self._bot.whisper('Database backup {} created in {:.1f} seconds'.format(filename, elapsed))
+
     @privileged
     @bot.command(ignore_extra=False, help=_help_messages['djmode'])
     async def djmode(self):
@@ -67,6 +85,44 @@ class Bot:
         await self._bot.message('Shutting down...')
         self._bot.loop.create_task(self._bot.shutdown())
 
+    @privileged
+    @bot.command(ignore_extra=False, help=_help_messages['stats'])
+    async def stats(self):
+        worker = self._bot.database.get_worker_stats()
+        reply = '**Database worker:**\n' \
+                '    **Queue depth:** {queue_depth}\n' \
+                '    **Jobs processed:** {jobs} in {transactions} transaction(s)\n' \
+                '    **Latency** (last {samples} jobs)**:** p50 {percentiles[50]:.1f} ms, ' \
+                'p95 {percentiles[95]:.1f} ms, p99 {percentiles[99]:.1f} ms\n' \
+                '    **Readers:** {readers}, queue depth {reader_queue_depth}'.format_map(worker)
+        validator = self._bot.validator.stats()
+        reply += '\n**Song validator:**\n' \
+                 '    **Songs checked:** {checked} ({remaining} stale remaining)\n' \
+                 '    **Flagged as failed:** {flagged}, **failed flag removed:** {cleared}, ' \
+                 '**duration updated:** {updated}\n'.format_map(validator) + \
+                 '    **Availability:** ' + (', '.join('{} {:.0%}'.format(service, rate) for service, rate
+                                                   in sorted(validator['hit_rates'].items())) or 'n/a')
+        cache = self._bot.database.get_extractor_cache_stats()
+        lookups = cache['hits'] + cache['misses'] + cache['negative_hits']
+        reply += '\n**Extractor cache:**\n' \
+                 '    **Lookups:** {}, **hits:** {hits}, **failures served:** {negative_hits}, **misses:** {misses}' \
+                 .format(lookups, **cache)
+        if lookups:
+            reply += ' (hit rate {:.0%})'.format((cache['hits'] + cache['negative_hits']) / lookups)
+        extractor = self._bot.extractor.stats()
+        reply += '\n    **Extractor calls:** {calls}, **coalesced:** {coalesced}, **in flight:** {in_flight}, ' \
+                 '**timed out:** {timeouts}'.format_map(extractor)
+        for lane in self._bot.extractor.lanes:
+            reply += '\n    **{} lane:** {running}/{cap} running, {queued} queued, queue latency p50 ' \
+                     '{percentiles[50]:.1f} ms, p95 {percentiles[95]:.1f} ms' \
+                .format(lane.capitalize(), **extractor['lanes'][lane])
+        reply += '\n    **Services:** ' + ', '.join('{} {state} ({failures}/{calls} failed)'.format(service, **stats)
+                                                   for service, stats in
+                                                   sorted(self._bot.database.get_breaker_stats().items()))
+        reply += '\n**Playlist imports:** {running}/{cap} running, {queued} queued' \
+            .format_map(self._bot.importer.stats())
+        await self._bot.whisper(reply)
+
     @bot.command(ignore_extra=False, aliases=['s'], help=_help_messages['status'])
     async def status(self):
         await self._bot.player.reprint_status()
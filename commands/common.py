@@ -8,3 +8,11 @@ log = logging.getLogger('ddmbot.commands')
 def privileged(command):
     command.privileged = True
     return command
+
+
+# Function formatting a duration in seconds as [h:]mm:ss
+def format_duration(seconds):
+    hours, seconds = divmod(seconds, 3600)
+    if hours:
+        return '{}:{:02d}:{:02d}'.format(hours, seconds // 60, seconds % 60)
+    return '{}:{:02d}'.format(seconds // 60, seconds % 60)
@@ -2,13 +2,14 @@ import discord.ext.commands as dec
 import discord.ext.commands.view as decw
 
 import database.playlist
+from commands.common import *
 
 
 class Playlist:
     """Playlist manipulation, switching, listing playlists and their content"""
     def __init__(self, bot):
         self._bot = bot
-        self._db = database.playlist.PlaylistInterface(bot.loop, bot.config['ddmbot'])
+        self._db = database.playlist.PlaylistInterface(bot.loop, bot.config['ddmbot'], bot.extractor)
 
     _help_messages = {
         'group': 'Playlist manipulation, switching, listing playlists and their content\n\n'
@@ -22,7 +23,12 @@ class Playlist:
 
         'append': 'Inserts the specified songs into your playlist\n\n'
         'Youtube, Soundcloud and Bandcamp services are supported (incl. playlists). You can specify multiple URLs or '
-        'song IDs in the command arguments. Songs are inserted *at the end* of your playlist.',
+        'song IDs in the command arguments. Songs are inserted *at the end* of your playlist.\nSongs are inserted in '
+        'the background, you will be informed about the progress in a private message.',
+
+        'cancel': 'Cancels your playlist imports\n\n'
+        'Import with the given ID is cancelled, or all of your imports if no ID is given. Songs inserted so far are '
+        'kept in the playlist.',
 
         'create': 'Creates new playlist with a given name\n\n'
         'The default behaviour for a new playlist is to repeat the songs in a loop.\nPlaylist will be automatically '
@@ -34,8 +40,18 @@ class Playlist:
         'delete': 'Removes the specified playlist\n\n'
         'Playlist is removed along with all the songs in it. This cannot be undone.',
 
+        'jobs': 'Lists your playlist imports\n\n'
+        'Imports being processed and waiting in the queue are listed along with their progress. Only one of your '
+        'imports is processed at a time.',
+
+        'link': 'Links your playlist to a remote playlist\n\n'
+        'Youtube playlists, Soundcloud sets and Bandcamp albums can be linked. Linked playlist can be synchronized '
+        'with the \'playlist sync\' command, it is also synchronized periodically. Songs removed from the remote '
+        'playlist are kept. Linked playlist is unlinked if no URL is given.',
+
         'list': 'Lists the available playlists\n\n'
-        'List of your playlist is be returned along with the number of songs and their repeat setting.',
+        'List of your playlist is be returned along with the number of songs, their total length and their repeat '
+        'setting.',
 
         'peek': 'Lists the songs in your playlist\n\n'
         'List of songs from your playlist is returned.\n\nDue to message length restrictions, up to 20 songs are '
@@ -52,7 +68,8 @@ class Playlist:
 
         'prepend': 'Inserts the specified songs into your playlist\n\n'
         'Youtube, Soundcloud and Bandcamp services are supported (incl. playlists). You can specify multiple URLs or '
-        'song IDs in the command arguments. Songs are inserted *at the beginning* of your playlist.',
+        'song IDs in the command arguments. Songs are inserted *at the beginning* of your playlist.\nSongs are '
+        'inserted in the background, you will be informed about the progress in a private message.',
 
         'repeat': 'Set repeat behaviour for your playlist\n\n'
         'You can switch between removing and repeating songs from your playlist after playing. The current setting '
@@ -64,7 +81,15 @@ class Playlist:
         'from the DJ queue. Active playlist is also the one modified by other \'playlist\' commands by default',
 
         'shuffle': 'Shuffles songs in your playlist\n\n'
-        'Randomly re-orders songs in the playlist.'
+        'Randomly re-orders songs in the playlist.',
+
+        'sort': 'Sorts songs in your playlist\n\n'
+        'Songs can be ordered by their \'title\' or \'duration\' (shortest first), or the current order can be '
+        'reversed by specifying \'reverse\'. Songs with the same title or duration keep their relative order.',
+
+        'sync': 'Inserts new songs from the linked remote playlist\n\n'
+        'Only the songs missing in your playlist are inserted (at the end of the playlist), in the background. '
+        'Playlist must be linked to a remote playlist with the \'playlist link\' command first.'
     }
 
     @dec.group(pass_context=True, invoke_without_command=True, aliases=['p'], help=_help_messages['group'])
@@ -123,6 +148,13 @@ class Playlist:
     async def append_explicit(self, ctx, playlist_name: str, *uris: str):
         return await self._insert(int(ctx.message.author.id), uris, playlist_name=playlist_name)
 
+    @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['cancel'])
+    async def cancel(self, ctx, job_id: int=None):
+        count = await self._bot.importer.cancel(int(ctx.message.author.id), job_id)
+        if not count:
+            return await self._bot.whisper('**You don\'t have any playlist imports**')
+        await self._bot.whisper('**{} import(s) cancelled**'.format(count))
+
     @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['create'])
     async def create(self, ctx, playlist_name: str, set_active: bool=True):
         await self._db.create(int(ctx.message.author.id), playlist_name)
@@ -149,6 +181,36 @@ class Playlist:
         await self._db.delete(int(ctx.message.author.id), playlist_name)
         await self._bot.whisper('**Playlist** {} **was removed**'.format(playlist_name))
 
+    @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['jobs'])
+    async def jobs(self, ctx):
+        jobs = await self._bot.importer.get_jobs(int(ctx.message.author.id))
+        if not jobs:
+            return await self._bot.whisper('**You don\'t have any playlist imports**')
+
+        reply = '**You currently have {} playlist import(s):**\n **>** '.format(len(jobs)) + \
+                '\n **>** '.join(['[#{}] to {} ({}, {} song(s) inserted, {} failed, {} item(s) remaining)'
+                                 .format(job.id, job.playlist, state, job.inserted, job.failed, remaining)
+                                 for job, state, remaining in jobs])
+        await self._bot.whisper(reply)
+
+    @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['link'])
+    async def link(self, ctx, url: str=None):
+        return await self._link(int(ctx.message.author.id), url)
+
+    @playlist.command(pass_context=True, ignore_extra=False, hidden=True)
+    async def link_explicit(self, ctx, playlist_name: str, url: str=None):
+        return await self._link(int(ctx.message.author.id), url, playlist_name)
+
+    async def _link(self, user_id, url, playlist_name=None):
+        # discord puts the links into the angle brackets to suppress the embeds
+        if url is not None:
+            url = url.strip('<>')
+        playlist_name = await self._db.link(user_id, url, playlist_name)
+        if url is None:
+            await self._bot.whisper('**Playlist** {} **was unlinked**'.format(playlist_name))
+        else:
+            await self._bot.whisper('**Playlist** {} **was linked to** <{}>'.format(playlist_name, url))
+
     @playlist.command(pass_context=True, ignore_extra=False, aliases=['l'], help=_help_messages['list'])
     async def list(self, ctx):
         items = await self._db.list(int(ctx.message.author.id))
@@ -156,9 +218,11 @@ class Playlist:
             return await self._bot.whisper('**You don\'t have any playlists**')
 
         reply = '**You currently have {} playlist(s):**\n **>** '.format(len(items)) + \
-                '\n **>** '.join(['{} ({} song(s), songs are {})'
-                                 .format(item['name'], item['song_count'],
-                                         'repeated' if item['repeat'] else 'removed after playing') for item in items])
+                '\n **>** '.join(['{} ({} song(s), {} total, songs are {}{})'
+                                 .format(item['name'], item['song_count'], format_duration(item['song_duration']),
+                                         'repeated' if item['repeat'] else 'removed after playing',
+                                         ', linked to <{}>'.format(item['source']) if item['source'] else '')
+                                  for item in items])
         await self._bot.whisper(reply)
 
     @playlist.command(pass_context=True, ignore_extra=False, aliases=['p'], help=_help_messages['peek'])
@@ -266,26 +330,45 @@ class Playlist:
         return await self._shuffle(int(ctx.message.author.id), playlist_name)
 
     async def _shuffle(self, user_id, playlist_name=None):
-        playlist_name = await self._db.shuffle(user_id, playlist_name)
+        playlist_name = await self._db.reorder(user_id, 'shuffle', playlist_name)
         await self._bot.whisper('**Playlist** {} **was shuffled**'.format(playlist_name))
 
-    async def _insert(self, user_id, uris, playlist_name=None, prepend=False):
-        # print the disclaimer
-        await self._bot.whisper('Please note that inserting new songs can take a while. Be patient and wait for the '
-                                'result. You can run other commands, but **avoid manipulating your playlist**.')
-        # now do the operation
-        playlist_name, inserted, failed, truncated, messages = await self._db.insert(user_id, playlist_name, prepend,
-                                                                                     uris)
-
-        reply = '**{} song(s) inserted to** {}\n{} insertion(s) failed'.format(inserted, playlist_name, failed)
-        if messages:
-            reply += '\n **>** ' + '\n **>** '.join(messages[:10])
-        if len(messages) > 10:
-            reply += '\n **>** ... (more messages suppressed)'
-        if truncated:
-            reply += '\n__**Inserting was cancelled before processing the whole input.**__'
+    @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['sort'])
+    async def sort(self, ctx, order: str):
+        return await self._sort(int(ctx.message.author.id), order)
 
-        await self._bot.whisper(reply)
+    @playlist.command(pass_context=True, ignore_extra=False, hidden=True)
+    async def sort_explicit(self, ctx, playlist_name: str, order: str):
+        return await self._sort(int(ctx.message.author.id), order, playlist_name)
+
+    async def _sort(self, user_id, order, playlist_name=None):
+        order = order.lower()
+        if order not in ('title', 'duration', 'reverse'):
+            raise dec.UserInputError('Valid options are \'title\', \'duration\' and \'reverse\'')
+        playlist_name = await self._db.reorder(user_id, order, playlist_name)
+        if order == 'reverse':
+            await self._bot.whisper('**Playlist** {} **was reversed**'.format(playlist_name))
+        else:
+            await self._bot.whisper('**Playlist** {} **was sorted by {}**'.format(playlist_name, order))
+
+    @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['sync'])
+    async def sync(self, ctx):
+        return await self._sync(int(ctx.message.author.id))
+
+    @playlist.command(pass_context=True, ignore_extra=False, hidden=True)
+    async def sync_explicit(self, ctx, playlist_name: str):
+        return await self._sync(int(ctx.message.author.id), playlist_name)
+
+    async def _sync(self, user_id, playlist_name=None):
+        playlist_name, count = await self._bot.importer.sync(user_id, playlist_name)
+        if not count:
+            await self._bot.whisper('**Playlist** {} **is up to date**'.format(playlist_name))
+
+    async def _insert(self, user_id, uris, playlist_name=None, prepend=False):
+        if not uris:
+            raise dec.UserInputError('You must specify at least one song to insert')
+        # songs are inserted in the background, progress is reported by the importer
+        await self._bot.importer.submit(user_id, playlist_name, prepend, uris)
 
     @staticmethod
     def _ordinal(n):
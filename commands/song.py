@@ -52,6 +52,11 @@ class Song:
         'Title and UURI are matched against the specified keywords. All the keywords must match either the title or '
         'UURI. Up to 20 results are returned.\nThis command can be used to lookup song IDs.',
 
+        'top': 'Lists the most played songs of the current day or week\n\n'
+        'Span can be either \'day\' or \'week\' (default), weeks start on monday. Up to 10 songs are returned, '
+        'ordered by the play count and the listener count. Statistics are updated in batches, the songs played within '
+        'the last minute or so may not be included yet.',
+
         'split': '* Marks a given song as an original\n\n'
         'This command can be used to fix duplication status of the song. After this command is issued, the song '
         'specified won\'t be marked as a duplicate anymore.\nThis is the inverse command to the \'deduplicate\'. '
@@ -141,3 +146,15 @@ class Song:
     async def split(self, song_id: int):
         await self._db.merge(song_id, song_id)
         await self._bot.message('Song [{}] has been marked as unique'.format(song_id))
+
+    @song.command(ignore_extra=False, aliases=['t'], help=_help_messages['top'])
+    async def top(self, span: str = 'week'):
+        if span not in database.song.ROLLUP_SPANS:
+            raise dec.UserInputError('Valid options are \'day\' and \'week\'')
+        start, items = await self._db.top(span, 10)
+        if not items:
+            await self._bot.whisper('No songs have been played this {} yet'.format(span))
+            return
+        reply = '**Top {} songs of the {} starting {}:**\n **>** '.format(len(items), span, start) + \
+                '\n **>** '.join(['[{}] {} (played {} time(s), {} listener(s))'.format(*item) for item in items])
+        await self._bot.whisper(reply)
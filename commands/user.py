@@ -17,6 +17,11 @@ class User:
         'grace': '* Removes the specified user from ignore list\n\n'
         'User may be specified by it\'s username, nick or mention.',
 
+        'history': 'Displays the recent activity of the user\n\n'
+        'User may be specified by it\'s username, nick or mention. Play and listen counts are listed for the last 7 '
+        'days and the last 4 weeks, along with the time the user last played a song from the DJ queue. Statistics are '
+        'updated in batches, the songs played within the last minute or so may not be included yet.',
+
         'ignore': '* Puts the specified user to the ignore list\n\n'
         'User may be specified by it\'s username, nick or mention. Bot will not react in any way to the ignored users. '
         'This action won\'t remove the user from the DJ queue nor listeners.\nNote that there is currently no way of '
@@ -46,6 +51,25 @@ class User:
         await self._db.grace(int(user.id))
         await self._bot.message('User {} successfully removed from the ignore list'.format(user))
 
+    @user.command(pass_context=True, ignore_extra=False, aliases=['h'], help=_help_messages['history'])
+    async def history(self, ctx, user: discord.User = None):
+        user = user if user is not None else ctx.message.author
+        history = await self._db.history(int(user.id), {'day': 7, 'week': 4})
+        if not history['week']:
+            await self._bot.whisper('User {} has no recent activity'.format(user))
+            return
+
+        reply = 'Recent activity of the user {}:'.format(user)
+        for span, header in (('day', 'Days'), ('week', 'Weeks')):
+            reply += '\n**{}:**'.format(header)
+            for start, play_count, listen_count, last_played in history[span]:
+                reply += '\n **>** {!s}: played {} time(s), listened to {} song(s)' \
+                    .format(start, play_count, listen_count)
+                if last_played is not None:
+                    reply += ', last played {:%Y-%m-%d %H:%M}'.format(last_played)
+
+        await self._bot.whisper(reply)
+
     @privileged
     @user.command(ignore_extra=False, help=_help_messages['ignore'])
     async def ignore(self, user: discord.User):
@@ -59,9 +83,10 @@ class User:
     async def info(self, ctx, user: discord.User = None):
         info = await self._db.info(int(user.id if user is not None else ctx.message.author.id))
 
-        reply = 'Statistics for the user {}:\n  {} song(s) in {} playlist(s)\n  Played {} time(s) from the DJ queue\n' \
-                '  Listened to {} song(s)' \
-                .format(user, info['song_count'], info['playlist_count'], info['play_count'], info['listen_count'])
+        reply = 'Statistics for the user {}:\n  {} song(s) in {} playlist(s), {} total\n' \
+                '  Played {} time(s) from the DJ queue\n  Listened to {} song(s)' \
+                .format(user, info['song_count'], info['playlist_count'], format_duration(info['song_duration']),
+                        info['play_count'], info['listen_count'])
         if info['ignored']:
             reply += "\n\nUser is ignored by the bot."
 
@@ -1,4 +1,8 @@
 import asyncio
+import glob
+import os
+import time
+from collections import Counter
 from datetime import datetime, timedelta
 
 from database.common import *
@@ -9,41 +13,243 @@ class IgnoredUserError(Exception):
 
 
 class BotInterface(DBInterface):
+    # maximum number of journal entries applied in a single transaction
+    _stats_batch_size = 1000
+
     def __init__(self, loop, config):
-        self._config_op_credit_cap = int(config['op_credit_cap'])
-        self._config_op_credit_renew = timedelta(hours=int(config['op_credit_renew']))
+        self._config_ap_check_period = int(config['ap_check_period']) * 3600
+        self._config_stats_flush_period = int(config['stats_flush_period'])
+        self._config_checkpoint_period = int(config['db_checkpoint_period']) * 60
+        self._config_optimize_period = int(config['db_optimize_period']) * 3600
+        self._config_backup_dir = config['db_backup_dir']
+        self._config_backup_period = int(config['db_backup_period']) * 3600
+        self._config_backup_count = int(config['db_backup_count'])
+        self._config_backup_pages = int(config['db_backup_pages'])
+        self._config_backup_delay = int(config['db_backup_delay']) / 1000
         DBInterface.__init__(self, loop)
+        self._backup_lock = asyncio.Lock(loop=loop)
+        self._credits.configure(int(config['op_credit_cap']), timedelta(hours=int(config['op_credit_renew'])))
+        self._autoplaylist.configure(int(config['ap_threshold']), float(config['ap_skip_ratio']),
+                                     int(config['song_length_limit']), int(config['op_interval']),
+                                     config.getboolean('ap_weighted'))
+        self._breakers.configure(int(config['breaker_window']), int(config['breaker_min_calls']),
+                                 int(config['breaker_failure_rate']) / 100, int(config['breaker_cooldown']))
+        self._extractor_cache.configure(int(config['extractor_meta_ttl']) * 3600,
+                                        int(config['extractor_stream_ttl']) * 60,
+                                        int(config['extractor_list_ttl']) * 60,
+                                        int(config['extractor_failure_ttl']) * 60)
+
+    async def interaction_check(self, user_id):
+        # users seen before are checked against the cache only
+        ignored = self._user_cache.is_ignored(user_id)
+        if ignored is None:
+            return await self._create_user(user_id)
+        if ignored:
+            raise IgnoredUserError
+        return False
 
     @in_executor
-    def interaction_check(self, user_id):
+    def _create_user(self, user_id):
         user, created = User.get_or_create(id=user_id)
+        self._user_cache.set_ignored(user_id, user.is_ignored)
         if user.is_ignored:
             raise IgnoredUserError
         return created
 
     @in_executor
-    def _credit_bump(self, timestamp, count):
-        # construct the queries and execute them in a transaction
-        ts_query = CreditTimestamp.update(last=timestamp)
-        credit_query = Song.update(
-            credit_count=peewee.fn.MIN(Song.credit_count + count, self._config_op_credit_cap))
-        with self._database.atomic():
-            ts_query.execute()
-            credit_query.execute()
+    def _renew_credits(self):
+        self._autoplaylist.renew_credits()
+
+    @in_reader
+    def _autoplaylist_check(self):
+        # the song table is scanned by a reader, the database worker is only blocked to swap the new content in
+        return self._autoplaylist.load(reload=True)
+
+    @in_executor
+    def _flush_stats(self):
+        flushed = 0
+        while True:
+            with self._database.atomic():
+                entries = list(StatsJournal.select(StatsJournal.id, StatsJournal.song, StatsJournal.dj,
+                                                   StatsJournal.listeners, StatsJournal.skip_vote_count,
+                                                   StatsJournal.played)
+                               .order_by(StatsJournal.id).limit(self._stats_batch_size).tuples())
+                if not entries:
+                    return flushed
+
+                # aggregate the counts first so every user and rollup row is updated just once
+                play_counts = Counter()
+                listen_counts = Counter()
+                history = list()
+                song_rollups = dict()
+                user_rollups = dict()
+                for entry_id, song_id, dj_id, listeners, skip_vote_count, played in entries:
+                    listeners = [int(listener) for listener in listeners.split(',')] if listeners else []
+                    history.append((song_id, dj_id, len(listeners), skip_vote_count, str(played)))
+                    if dj_id is not None:
+                        play_counts[dj_id] += 1
+                    listen_counts.update(listeners)
+
+                    for span in ROLLUP_SPANS:
+                        start = rollup_start(span, played.date()).isoformat()
+                        counts = song_rollups.setdefault((span, start, song_id), [0, 0, 0])
+                        counts[0] += 1
+                        counts[1] += len(listeners)
+                        counts[2] += skip_vote_count
+                        for user_id in listeners:
+                            user_rollups.setdefault((span, start, user_id), [0, 0, None])[1] += 1
+                        if dj_id is not None:
+                            counts = user_rollups.setdefault((span, start, dj_id), [0, 0, None])
+                            counts[0] += 1
+                            counts[2] = str(played)
+
+                cursor = self._database.get_cursor()
+                cursor.executemany('UPDATE "user" SET "play_count" = "play_count" + ? WHERE "id" = ?',
+                                   [(count, user_id) for user_id, count in play_counts.items()])
+                cursor.executemany('UPDATE "user" SET "listen_count" = "listen_count" + ? WHERE "id" = ?',
+                                   [(count, user_id) for user_id, count in listen_counts.items()])
+                cursor.executemany('INSERT INTO "playhistory" ("song_id", "dj", "listener_count", "skip_vote_count", '
+                                   '"played") VALUES (?, ?, ?, ?, ?)', history)
+                # rollup rows are created on demand, then incremented
+                cursor.executemany('INSERT OR IGNORE INTO "songrollup" ("span", "start", "song_id", "play_count", '
+                                   '"listener_count", "skip_vote_count") VALUES (?, ?, ?, 0, 0, 0)',
+                                   list(song_rollups))
+                cursor.executemany('UPDATE "songrollup" SET "play_count" = "play_count" + ?, '
+                                   '"listener_count" = "listener_count" + ?, "skip_vote_count" = "skip_vote_count" + ? '
+                                   'WHERE "span" = ? AND "start" = ? AND "song_id" = ?',
+                                   [tuple(counts) + key for key, counts in song_rollups.items()])
+                cursor.executemany('INSERT OR IGNORE INTO "userrollup" ("span", "start", "user", "play_count", '
+                                   '"listen_count") VALUES (?, ?, ?, 0, 0)', list(user_rollups))
+                cursor.executemany('UPDATE "userrollup" SET "play_count" = "play_count" + ?, '
+                                   '"listen_count" = "listen_count" + ?, '
+                                   '"last_played" = COALESCE(MAX("last_played", ?), "last_played", ?) '
+                                   'WHERE "span" = ? AND "start" = ? AND "user" = ?',
+                                   [(counts[0], counts[1], counts[2], counts[2]) + key
+                                    for key, counts in user_rollups.items()])
+                # journal entries are removed in the same transaction, applying them is all-or-nothing
+                StatsJournal.delete().where(StatsJournal.id <= entries[-1][0]).execute()
+
+            flushed += len(entries)
+
+    async def backup(self):
+        if self._backup_lock.locked():
+            raise RuntimeError('Database backup is already in progress')
+
+        async with self._backup_lock:
+            os.makedirs(self._config_backup_dir, exist_ok=True)
+            filename = os.path.join(self._config_backup_dir, datetime.now().strftime('db-%Y%m%d-%H%M%S.sqlite'))
+            start_time = time.monotonic()
+            # backup is written under a temporary name, incomplete snapshots are never rotated in
+            try:
+                await self._loop.run_in_executor(None, backup_database, filename + '.part',
+                                                 self._config_backup_pages, self._config_backup_delay)
+                os.replace(filename + '.part', filename)
+            except:
+                if os.path.exists(filename + '.part'):
+                    os.remove(filename + '.part')
+                raise
+            elapsed = time.monotonic() - start_time
+
+            # timestamped names sort chronologically, only the newest snapshots are kept
+            snapshots = sorted(glob.glob(os.path.join(self._config_backup_dir, 'db-*.sqlite')))
+            for snapshot in snapshots[:-self._config_backup_count]:
+                os.remove(snapshot)
+
+        log.info('Database backup {} created in {:.1f} s'.format(filename, elapsed))
+        return filename, elapsed
+
+    @in_reader
+    def _check_integrity(self):
+        return check_integrity()
+
+    @in_executor
+    def _fix_summary_counters(self, playlist_ids, user_ids):
+        return fix_summary_counters(playlist_ids, user_ids)
+
+    # checkpoint cannot run inside of a transaction
+    @in_executor_standalone
+    def _checkpoint(self):
+        return self._database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE);').fetchone()
+
+    @in_executor
+    def _purge_extractor_cache(self):
+        # entries not updated for longer than any of the TTLs are expired completely
+        threshold = datetime.now() - timedelta(seconds=self._extractor_cache.max_ttl)
+        return ExtractorCache.delete().where(ExtractorCache.updated < threshold).execute()
+
+    def get_extractor_cache_stats(self):
+        return self._extractor_cache.stats()
+
+    def get_breaker_stats(self):
+        return self._breakers.stats()
+
+    @in_executor_standalone
+    def _optimize(self):
+        self._database.execute_sql('PRAGMA optimize;')
 
     async def task_credit_renew(self):
-        # check if the last timestamp is present in the database
-        if CreditTimestamp.select().count() == 0:
-            CreditTimestamp.create(last=datetime.now())
+        # credit counts are derived from the current epoch on read, we just need to release exhausted songs
+        while True:
+            # wake up slightly after the epoch boundary
+            await asyncio.sleep(self._credits.until_next_epoch() + 1, loop=self._loop)
+            await self._renew_credits()
+
+    async def task_autoplaylist_check(self):
+        # the first iteration loads the pool, the following ones look for the inconsistencies
+        while True:
+            differences = await self._autoplaylist_check()
+            if differences:
+                log.warning('Automatic playlist pool consistency check fixed {} difference(s)'.format(differences))
+            await asyncio.sleep(self._config_ap_check_period, loop=self._loop)
+
+    async def task_stats_flush(self):
+        # the first iteration applies the entries left in the journal by the previous run
+        while True:
+            flushed = await self._flush_stats()
+            if flushed:
+                log.debug('Statistics of {} played song(s) flushed from the journal'.format(flushed))
+            await asyncio.sleep(self._config_stats_flush_period, loop=self._loop)
+
+    async def task_database_maintenance(self):
+        # integrity check is done here rather than on startup, the bot is usable while it runs
+        failed, playlist_ids, user_ids = await self._check_integrity()
+        if failed:
+            log.critical('Foreign key constrains check failed for {} row(s), database is corrupted and needs to be '
+                         'fixed'.format(failed))
+        # only the mismatching counters are sent to the worker thread, the scans above are done by a reader
+        if playlist_ids or user_ids:
+            fixed = await self._fix_summary_counters(playlist_ids, user_ids)
+            if fixed:
+                log.warning('{} playlist summary counter(s) did not match the playlist content and were fixed'
+                            .format(fixed))
+
+        # WAL file is truncated periodically so it doesn't grow unbounded, query planner statistics less often
+        until_optimize = self._config_optimize_period
+        while True:
+            await asyncio.sleep(self._config_checkpoint_period, loop=self._loop)
+            busy, wal_pages, checkpointed = await self._checkpoint()
+            if busy:
+                log.debug('Database checkpoint could not complete, {} of {} WAL page(s) checkpointed'
+                          .format(checkpointed, wal_pages))
+
+            until_optimize -= self._config_checkpoint_period
+            if until_optimize <= 0:
+                purged = await self._purge_extractor_cache()
+                if purged:
+                    log.debug('{} expired extractor cache entries purged'.format(purged))
+                await self._optimize()
+                until_optimize = self._config_optimize_period
+
+    async def task_database_backup(self):
+        if not self._config_backup_period:
+            return
 
-        # now the endless task loop
         while True:
-            current_time = datetime.now()
-            last_time = CreditTimestamp.get().last
-            credits_to_add = (current_time - last_time) // self._config_op_credit_renew
-            if credits_to_add > 0:
-                # written timestamp correction
-                written_timestamp = last_time + (credits_to_add * self._config_op_credit_renew)
-                self._credit_bump(written_timestamp, credits_to_add)
-            # next check in an hour
-            await asyncio.sleep(3600, loop=self._loop)
+            await asyncio.sleep(self._config_backup_period, loop=self._loop)
+            try:
+                await self.backup()
+            except RuntimeError:
+                # backup requested by an operator is in progress already
+                pass
+            except Exception:
+                log.exception('Periodic database backup failed')
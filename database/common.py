@@ -1,23 +1,55 @@
+import asyncio
+import collections
+import concurrent.futures
 import functools
+import heapq
+import json
 import logging
+import queue
+import random
 import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
 
 import peewee
 import youtube_dl
 
+from extractor import TransientExtractionError
+
 # set up the logger
 log = logging.getLogger('ddmbot.database')
 
 # database object
 _database = peewee.SqliteDatabase(None, pragmas=[('journal_mode', 'WAL'), ('foreign_keys', 'ON')])
 
+# pragma profiles applied to every connection opened, see db_profile in the configuration file
+_pragma_profiles = {
+    # every commit is synced to the disk, small memory footprint
+    'safe': [('synchronous', 'FULL'), ('cache_size', -2000), ('mmap_size', 0), ('temp_store', 'DEFAULT')],
+    # in the WAL mode, database cannot be corrupted, but the last commits may be lost on a power failure
+    'balanced': [('synchronous', 'NORMAL'), ('cache_size', -16000), ('mmap_size', 67108864),
+                 ('temp_store', 'MEMORY')],
+    # as balanced, trading more memory for speed
+    'fast': [('synchronous', 'NORMAL'), ('cache_size', -65536), ('mmap_size', 268435456), ('temp_store', 'MEMORY')]
+}
+_pragmas = _pragma_profiles['balanced']
+
+
+# helper function connecting the calling thread to the database, applying the pragma profile
+def _connect():
+    _database.connect()
+    for name, value in _pragmas:
+        _database.execute_sql('PRAGMA {} = {};'.format(name, value))
+
 
 class DdmBotSchema(peewee.Model):
     class Meta:
         database = _database
 
 
-# Class to store timestamp in the database
+# Class to store timestamp in the database -- origin of the credit renewal epochs
 class CreditTimestamp(DdmBotSchema):
     last = peewee.DateTimeField()
 
@@ -39,11 +71,15 @@ class Song(DdmBotSchema):
     # overplaying protection
     last_played = peewee.DateTimeField()
     credit_count = peewee.IntegerField()
+    # renewal epoch the credit_count is valid for, credits are added lazily on read
+    credit_epoch = peewee.IntegerField(default=0)
 
     # automatic playlist
     listener_count = peewee.IntegerField(default=0)
     skip_vote_count = peewee.IntegerField(default=0)
     has_failed = peewee.BooleanField(default=False)
+    # last time the availability of the song was checked by the background validator
+    last_validated = peewee.DateTimeField(null=True)
 
     # song may be duplicated using multiple sources
     duplicate = peewee.ForeignKeyField('self', null=True)
@@ -67,6 +103,14 @@ class Playlist(DdmBotSchema):
     # playlist may be set to repeat itself, this is default except to implicit one
     repeat = peewee.BooleanField(default=True)
 
+    # summary counters maintained along with the links
+    song_count = peewee.IntegerField(default=0)
+    song_duration = peewee.IntegerField(default=0)
+
+    # remote list the playlist is synchronized with and the time of the last synchronization attempt
+    source = peewee.CharField(null=True)
+    synced = peewee.DateTimeField(null=True)
+
     class Meta:
         # we want the couple (user, name) to be unique (so no user has two playlists with the same name)
         constraints = [peewee.SQL('UNIQUE(user_id, name)')]
@@ -93,12 +137,113 @@ class User(DdmBotSchema):
     play_count = peewee.IntegerField(default=0)
     listen_count = peewee.IntegerField(default=0)
 
+    # summary counters for all the playlists of the user, maintained along with the links
+    song_count = peewee.IntegerField(default=0)
+    song_duration = peewee.IntegerField(default=0)
+
     # for checking if the user should be ignored by the ddmbot
     is_ignored = peewee.BooleanField(default=False)
 
 DeferredUser.set_model(User)
 
 
+# Append-only journal of played songs, user statistics are updated from it in batches
+class StatsJournal(DdmBotSchema):
+    id = peewee.PrimaryKeyField()
+
+    song = peewee.ForeignKeyField(Song)
+    # DJ is not present for the automatic playlist
+    dj = peewee.BigIntegerField(null=True)
+    # comma separated discord ids of all the listeners
+    listeners = peewee.TextField()
+    skip_vote_count = peewee.IntegerField()
+    played = peewee.DateTimeField()
+
+
+# Append-only history of the played songs, filled from the StatsJournal
+class PlayHistory(DdmBotSchema):
+    id = peewee.PrimaryKeyField()
+
+    song = peewee.ForeignKeyField(Song)
+    dj = peewee.BigIntegerField(null=True)
+    listener_count = peewee.IntegerField()
+    skip_vote_count = peewee.IntegerField()
+    played = peewee.DateTimeField()
+
+
+# Spans of the statistics rollups -- daily and weekly (starting on monday)
+ROLLUP_SPANS = ('day', 'week')
+
+
+# Function returning the first day of the rollup span the given date belongs to
+def rollup_start(span, day):
+    if span == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+# Song statistics aggregated per rollup span, maintained incrementally with the history
+class SongRollup(DdmBotSchema):
+    span = peewee.CharField()
+    start = peewee.DateField()
+    song = peewee.ForeignKeyField(Song, index=False)
+
+    play_count = peewee.IntegerField(default=0)
+    listener_count = peewee.IntegerField(default=0)
+    skip_vote_count = peewee.IntegerField(default=0)
+
+    class Meta:
+        primary_key = peewee.CompositeKey('span', 'start', 'song')
+        # top songs of a span are read in the index order
+        indexes = ((('span', 'start', 'play_count', 'listener_count'), False),)
+
+
+# User statistics aggregated per rollup span, maintained incrementally with the history
+class UserRollup(DdmBotSchema):
+    # listeners does not have to be in the user table, no foreign key here
+    user = peewee.BigIntegerField()
+    span = peewee.CharField()
+    start = peewee.DateField()
+
+    play_count = peewee.IntegerField(default=0)
+    listen_count = peewee.IntegerField(default=0)
+    # last time the user played a song as a DJ within the span
+    last_played = peewee.DateTimeField(null=True)
+
+    class Meta:
+        primary_key = peewee.CompositeKey('user', 'span', 'start')
+
+
+# Persistent cache of the youtube_dl results, see ExtractorCachePolicy
+class ExtractorCache(DdmBotSchema):
+    # unique URI for the songs, URL otherwise
+    key = peewee.CharField(primary_key=True)
+    # JSON object mapping the cached fields to [value, unix timestamp] pairs
+    fields = peewee.TextField(default='{}')
+    # message and unix timestamp of the last download error, cleared on success
+    failure = peewee.TextField(null=True)
+    failed = peewee.DoubleField(null=True)
+    # for purging the entries not used for a long time
+    updated = peewee.DateTimeField(index=True)
+
+
+# Playlist imports processed in the background, see importer.Importer
+class ImportJob(DdmBotSchema):
+    id = peewee.PrimaryKeyField()
+
+    # playlist may be deleted while the job is queued, no foreign keys here
+    user = peewee.BigIntegerField(index=True)
+    playlist = peewee.CharField()
+    prepend = peewee.BooleanField()
+    # JSON list of the input not processed yet, lists are stored expanded once fetched
+    uris = peewee.TextField()
+    # progress so far, messages are kept as a JSON list
+    inserted = peewee.IntegerField(default=0)
+    failed = peewee.IntegerField(default=0)
+    messages = peewee.TextField(default='[]')
+    created = peewee.DateTimeField()
+
+
 # Model to retrieve failed foreign key constrains
 class ForeignKeyCheckModel(DdmBotSchema):
     table = peewee.CharField()
@@ -107,19 +252,763 @@ class ForeignKeyCheckModel(DdmBotSchema):
     fkid = peewee.IntegerField()
 
 
+#
+# Overplay protection credits derived from the renewal epochs
+#
+# Instead of bumping credit_count of every song periodically, each song stores the epoch (number of renewal periods
+# since the origin stored in CreditTimestamp) its credit_count was written in. The current credit count is then
+# MIN(credit_count + current_epoch - credit_epoch, cap).
+#
+class CreditClock:
+    def __init__(self):
+        self._origin = None
+        self._period = timedelta(hours=24)
+        self._cap = 0
+
+    def configure(self, cap, period):
+        self._cap = cap
+        self._period = period
+
+    def load(self):
+        # check if the origin timestamp is present in the database
+        try:
+            self._origin = CreditTimestamp.get().last
+        except CreditTimestamp.DoesNotExist:
+            self._origin = CreditTimestamp.create(last=datetime.now()).last
+
+    def epoch(self, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.now()
+        return (timestamp - self._origin) // self._period
+
+    def until_next_epoch(self):
+        next_epoch = self._origin + (self.epoch() + 1) * self._period
+        return (next_epoch - datetime.now()).total_seconds()
+
+    def count(self, credit_count, credit_epoch, epoch=None):
+        if epoch is None:
+            epoch = self.epoch()
+        return min(credit_count + epoch - credit_epoch, self._cap)
+
+    def expression(self, epoch=None):
+        if epoch is None:
+            epoch = self.epoch()
+        return peewee.fn.MIN(Song.credit_count - Song.credit_epoch + epoch, self._cap)
+
+_credits = CreditClock()
+
+
+#
+# Song ids of the automatic playlist pool in their states (see AutoplaylistPool below), active songs are kept in a list
+# per service, so the songs of the services unavailable at the moment are not picked at all
+#
+class _PoolContent:
+    def __init__(self):
+        self.ids = collections.defaultdict(list)  # maps service -> active song ids, random access
+        self.index = dict()  # maps song id -> (service, position in self.ids[service])
+        self.weights = dict()  # maps active song id -> selection weight (0, 1]
+        self.cooling = dict()  # maps song id -> (release time, weight, service)
+        self.cooling_heap = list()  # heap of (release time, song id), may contain stale entries
+        self.exhausted = dict()  # maps song id -> (release time, weight, service)
+
+    @property
+    def size(self):
+        return len(self.index), len(self.cooling), len(self.exhausted)
+
+    def insert(self, song_id, state):
+        if state is None:
+            return
+        kind, release_time, weight, service = state
+        if kind == 'active':
+            ids = self.ids[service]
+            self.index[song_id] = (service, len(ids))
+            ids.append(song_id)
+            self.weights[song_id] = weight
+        elif kind == 'cooling':
+            self.cooling[song_id] = (release_time, weight, service)
+            heapq.heappush(self.cooling_heap, (release_time, song_id))
+        else:
+            self.exhausted[song_id] = (release_time, weight, service)
+
+    def discard(self, song_id):
+        entry = self.index.pop(song_id, None)
+        if entry is not None:
+            # swap with the last element to keep the removal O(1)
+            service, position = entry
+            ids = self.ids[service]
+            last_id = ids.pop()
+            if last_id != song_id:
+                ids[position] = last_id
+                self.index[last_id] = (service, position)
+            self.weights.pop(song_id)
+        self.cooling.pop(song_id, None)  # heap entry is left behind and skipped once popped
+        self.exhausted.pop(song_id, None)
+
+    def release_cooled(self, current_time):
+        while self.cooling_heap and self.cooling_heap[0][0] < current_time:
+            release_time, song_id = heapq.heappop(self.cooling_heap)
+            entry = self.cooling.get(song_id)
+            if entry is None or entry[0] != release_time:
+                continue  # stale heap entry
+            del self.cooling[song_id]
+            self.insert(song_id, ('active',) + entry)
+
+    def renew_credits(self, current_time):
+        exhausted = self.exhausted
+        self.exhausted = dict()
+        for song_id, entry in exhausted.items():
+            self.insert(song_id, ('cooling' if entry[0] > current_time else 'active',) + entry)
+
+    def snapshot(self):
+        # active and cooling songs are not distinguished, it depends on the time of the snapshot only
+        state = {song_id: 'eligible' for song_id in self.index}
+        state.update((song_id, 'eligible') for song_id in self.cooling)
+        state.update((song_id, 'exhausted') for song_id in self.exhausted)
+        return state
+
+
+#
+# In-memory pool of songs eligible for the automatic playlist
+#
+# Songs passing the static conditions (listener threshold, skip ratio, duration, blacklist, failure and duplicate flags)
+# are tracked in one of three states: active (can be picked right away), cooling (played recently, released once the
+# overplay protection interval passes) and exhausted (no credits left, released by the credit renewal). Interfaces
+# notify the pool about every change of the relevant song attributes so the pool never needs to scan the table.
+#
+# The table is only scanned by load(), which must be run by a reader. New content is built without holding the lock,
+# so the database worker (notifying the pool about the changes) is never blocked by it. Changes notified during the
+# scan are recorded and applied again once the new content is swapped in.
+#
+class AutoplaylistPool:
+    # how many times the weighted selection is retried before falling back to the uniform one
+    _weighted_attempts = 32
+    # maximum number of song ids in a single refresh query
+    _refresh_batch_size = 500
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._generation = 0  # incremented by every configuration change, loads of older generations are dropped
+        self._pending = None  # maps song id -> state notified during a load, None if there is no load running
+
+        self._threshold = 0
+        self._ratio = 0.0
+        self._max_duration = 0
+        self._interval = timedelta()
+        self._weighted = False
+
+        self._content = _PoolContent()
+
+    def configure(self, threshold, ratio, max_duration, interval, weighted):
+        with self._lock:
+            self._threshold = threshold
+            self._ratio = ratio
+            self._max_duration = max_duration
+            self._interval = timedelta(seconds=interval)
+            self._weighted = weighted
+            self._loaded = False
+            self._generation += 1
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def size(self):
+        return self._content.size
+
+    #
+    # Loading, to be run by a reader
+    #
+    def load(self, reload=False):
+        # returns the number of differences between the old and the new content when reloading
+        with self._load_lock:
+            with self._lock:
+                if self._loaded and not reload:
+                    return 0
+                generation = self._generation
+                query = self._candidates().tuples()
+                self._pending = dict()
+
+            try:
+                current_time = datetime.now()
+                epoch = _credits.epoch(current_time)
+                content = _PoolContent()
+                # peewee 2.x .iterator() breaks on python 3.7+ (PEP 479), the pool candidates are iterated plainly
+                for row in query:
+                    content.insert(row[0], self._classify(row, current_time, epoch))
+                state = content.snapshot() if reload else None
+
+                with self._lock:
+                    if generation != self._generation:
+                        return 0  # configuration has changed, load is done again by the next user
+                    pending = self._pending
+                    for song_id, song_state in pending.items():
+                        content.discard(song_id)
+                        content.insert(song_id, song_state)
+                    current_time = datetime.now()
+                    if _credits.epoch(current_time) != epoch:
+                        content.renew_credits(current_time)
+                    old_content = self._content if self._loaded else None
+                    self._content = content
+                    self._loaded = True
+            finally:
+                with self._lock:
+                    self._pending = None
+
+        # old content is not modified anymore, songs changed during the load are not counted as differences
+        differences = 0
+        if old_content is not None and state is not None:
+            differences = len({song_id for song_id, song_state in set(old_content.snapshot().items()) ^
+                               set(state.items()) if song_id not in pending})
+        log.info('Automatic playlist pool loaded: {} active, {} cooling, {} exhausted'.format(*content.size))
+        return differences
+
+    #
+    # Selection
+    #
+    def pick(self, blocked=()):
+        # songs of the blocked services are not picked, None is returned when there is no song to pick or the pool is
+        # not loaded yet
+        with self._lock:
+            if not self._loaded:
+                return None
+            content = self._content
+            content.release_cooled(datetime.now())
+            lists = [ids for service, ids in content.ids.items() if ids and service not in blocked]
+            total = sum(len(ids) for ids in lists)
+            if not total:
+                return None
+
+            def choice():
+                # uniform over all the songs of the allowed services
+                position = random.randrange(total)
+                for ids in lists:
+                    if position < len(ids):
+                        return ids[position]
+                    position -= len(ids)
+
+            candidate = choice()
+            if self._weighted:
+                # rejection sampling keeps the selection O(1) on average, weights are never higher than 1
+                for _ in range(self._weighted_attempts):
+                    if random.random() < content.weights[candidate]:
+                        break
+                    candidate = choice()
+            return candidate
+
+    def verify(self, song):
+        # checks if the song picked is really eligible, fixing the pool state if it is not
+        with self._lock:
+            state = self._classify(self._row(song), datetime.now())
+            if state is not None and state[0] == 'active':
+                return True
+            log.warning('Automatic playlist pool was out of sync for the song [{}]'.format(song.id))
+            self._update(song.id, state)
+            return False
+
+    #
+    # Change notifications
+    #
+    def refresh(self, song_ids):
+        song_ids = [song_id for song_id in song_ids if song_id is not None]
+        with self._lock:
+            if not (self._loaded or self._pending is not None) or not song_ids:
+                return
+            current_time = datetime.now()
+            states = dict.fromkeys(song_ids)
+            for offset in range(0, len(song_ids), self._refresh_batch_size):
+                batch = song_ids[offset:offset + self._refresh_batch_size]
+                for row in self._query().where(Song.id << batch).tuples():
+                    states[row[0]] = self._classify(row, current_time)
+            for song_id, state in states.items():
+                self._update(song_id, state)
+
+    def renew_credits(self):
+        # a load running at the moment checks the epoch on its own
+        with self._lock:
+            self._content.renew_credits(datetime.now())
+
+    #
+    # Internal helpers, lock must be held
+    #
+    @staticmethod
+    def _query():
+        # columns are in the order expected by _classify
+        return Song.select(Song.id, Song.listener_count, Song.skip_vote_count, Song.duration, Song.is_blacklisted,
+                           Song.has_failed, Song.duplicate, Song.last_played, Song.credit_count, Song.credit_epoch,
+                           Song.uuri)
+
+    @staticmethod
+    def _row(song):
+        return (song.id, song.listener_count, song.skip_vote_count, song.duration, song.is_blacklisted,
+                song.has_failed, song.duplicate_id, song.last_played, song.credit_count, song.credit_epoch, song.uuri)
+
+    def _candidates(self):
+        # the last three conditions must stay literal to match the song_autoplaylist partial index, peewee would bind
+        # the NULL as a parameter and the query planner cannot prove the index condition then
+        return self._query().where(
+            Song.listener_count >= self._threshold,  # listener threshold
+            Song.skip_vote_count < peewee.Passthrough(self._ratio) * Song.listener_count,  # skip ratio
+            Song.duration <= self._max_duration,  # song duration
+            ~Song.is_blacklisted,  # cannot be blacklisted
+            ~Song.has_failed,  # probably unavailable
+            peewee.SQL('"duplicate_id" IS NULL')  # not fair + outdated information
+        )
+
+    def _update(self, song_id, state):
+        if self._loaded:
+            self._content.discard(song_id)
+            self._content.insert(song_id, state)
+        if self._pending is not None:
+            self._pending[song_id] = state
+
+    def _classify(self, row, current_time, epoch=None):
+        song_id, listener_count, skip_vote_count, duration, is_blacklisted, has_failed, duplicate_id, last_played, \
+            credit_count, credit_epoch, uuri = row
+        if listener_count < self._threshold or skip_vote_count >= self._ratio * listener_count or \
+                duration > self._max_duration or is_blacklisted or has_failed or duplicate_id is not None:
+            return None
+        weight = 1.0 - skip_vote_count / listener_count if listener_count else 1.0
+        release_time = last_played + self._interval
+        service = uuri.split(':')[0]
+        if _credits.count(credit_count, credit_epoch, epoch) <= 0:
+            return 'exhausted', release_time, weight, service
+        if release_time >= current_time:
+            return 'cooling', release_time, weight, service
+        return 'active', release_time, weight, service
+
+_autoplaylist = AutoplaylistPool()
+
+
+#
+# Write-through cache of the known users and the ignore list
+#
+# It allows to check for the ignored users on every command without a database round trip. The cache is loaded at the
+# initialization and updated by the interfaces whenever a user is created, ignored or graced.
+#
+class UserCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = set()
+        self._ignored = set()
+
+    def load(self):
+        with self._lock:
+            self._known.clear()
+            self._ignored.clear()
+            for user_id, is_ignored in User.select(User.id, User.is_ignored).tuples():
+                self._known.add(user_id)
+                if is_ignored:
+                    self._ignored.add(user_id)
+
+    def is_ignored(self, user_id):
+        # None is returned for the users not present in the database yet
+        with self._lock:
+            if user_id not in self._known:
+                return None
+            return user_id in self._ignored
+
+    def set_ignored(self, user_id, ignored):
+        with self._lock:
+            self._known.add(user_id)
+            if ignored:
+                self._ignored.add(user_id)
+            else:
+                self._ignored.discard(user_id)
+
+_user_cache = UserCache()
+
+
+#
+# Time-to-live policy and statistics of the persistent extractor cache
+#
+# Every field of the extractor result is cached with its own timestamp and checked against the TTL of its class, so
+# long-lived metadata (titles, durations) outlive the stream URLs. Download errors are cached as well, for a short time.
+#
+class ExtractorCachePolicy:
+    _field_classes = {'title': 'meta', 'description': 'meta', 'duration': 'meta', 'extractor': 'meta',
+                      'url': 'stream', 'entries': 'list'}
+
+    def __init__(self):
+        self._ttls = {'meta': 7 * 86400, 'stream': 3600, 'list': 600}
+        self._failure_ttl = 1800
+        self._hits = 0
+        self._misses = 0
+        self._negative_hits = 0
+
+    def configure(self, meta_ttl, stream_ttl, list_ttl, failure_ttl):
+        self._ttls = {'meta': meta_ttl, 'stream': stream_ttl, 'list': list_ttl}
+        self._failure_ttl = failure_ttl
+
+    @property
+    def max_ttl(self):
+        return max(max(self._ttls.values()), self._failure_ttl)
+
+    def stats(self):
+        return {'hits': self._hits, 'misses': self._misses, 'negative_hits': self._negative_hits}
+
+    def lookup(self, entry, fields):
+        # returns all the fresh fields if the requested ones are fresh, None otherwise
+        if entry is None:
+            self._misses += 1
+            return None
+        cached_fields, failure, failed = entry
+        now = time.time()
+        if failure is not None and now - failed < self._failure_ttl:
+            self._negative_hits += 1
+            raise youtube_dl.DownloadError(failure)
+
+        info = {field: value for field, (value, timestamp) in json.loads(cached_fields).items()
+                if now - timestamp < self._ttls[self._field_classes[field]]}
+        if not all(field in info for field in fields):
+            self._misses += 1
+            return None
+        self._hits += 1
+        return info
+
+    def merge(self, cached_fields, result):
+        # only the fields used by the bot are stored, playlist entries are trimmed as well
+        fields = json.loads(cached_fields) if cached_fields else dict()
+        now = time.time()
+        for field in self._field_classes:
+            if field not in result:
+                continue
+            value = result[field]
+            if field == 'entries':
+                value = [{'id': entry.get('id'), 'url': entry.get('url')} for entry in value]
+            elif field == 'url' and result.get('is_live'):
+                # live stream URLs are short-lived and must never be reused
+                continue
+            fields[field] = [value, now]
+        return json.dumps(fields)
+
+_extractor_cache = ExtractorCachePolicy()
+
+
+# Raised instead of the download errors while the service is considered unavailable
+class ServiceUnavailableError(Exception):
+    pass
+
+
+#
+# Circuit breaker of a single service (youtube, soundcloud, bandcamp)
+#
+# Outcomes of the recent extractions are kept in a window. When the failure rate in the window reaches the threshold,
+# the breaker opens and no calls are made for the cooldown period. After that, a single probe is allowed through
+# (half-open state) -- breaker closes on its success and opens again on its failure.
+#
+class CircuitBreaker:
+    def __init__(self, service):
+        self._service = service
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=20)
+        self._min_calls = 5
+        self._threshold = 0.5
+        self._cooldown = 300
+        self._state = 'closed'
+        self._opened = 0
+        self._probing = False
+
+    def configure(self, window, min_calls, threshold, cooldown):
+        with self._lock:
+            self._outcomes = collections.deque(self._outcomes, maxlen=window)
+            self._min_calls = min_calls
+            self._threshold = threshold
+            self._cooldown = cooldown
+
+    def stats(self):
+        with self._lock:
+            return {'state': self._state, 'calls': len(self._outcomes), 'failures': self._outcomes.count(False)}
+
+    def allows(self):
+        # only checks if a call would be let through, for the song selection
+        with self._lock:
+            if self._state == 'open':
+                return time.monotonic() - self._opened >= self._cooldown
+            return self._state == 'closed' or not self._probing
+
+    def acquire(self):
+        with self._lock:
+            if self._state == 'open' and time.monotonic() - self._opened >= self._cooldown:
+                self._state = 'half-open'
+            if self._state == 'closed':
+                return True
+            if self._state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def release(self):
+        # call was cancelled, its outcome is unknown
+        with self._lock:
+            self._probing = False
+
+    def record(self, success):
+        # returns True if the service is still considered available
+        with self._lock:
+            if self._state == 'half-open':
+                self._probing = False
+                if success:
+                    log.info('Service {} is available again, circuit breaker closed'.format(self._service))
+                    self._state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return success
+            if self._state == 'open':
+                return success
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self._min_calls and failures >= self._threshold * len(self._outcomes):
+                log.warning('Service {} failed {} of the last {} call(s), circuit breaker opened'
+                            .format(self._service, failures, len(self._outcomes)))
+                self._open()
+            return self._state == 'closed'
+
+    def _open(self):
+        self._state = 'open'
+        self._opened = time.monotonic()
+
+
+class ServiceBreakers:
+    def __init__(self, services):
+        self._breakers = {service: CircuitBreaker(service) for service in services}
+
+    def configure(self, window, min_calls, threshold, cooldown):
+        for breaker in self._breakers.values():
+            breaker.configure(window, min_calls, threshold, cooldown)
+
+    def get(self, service):
+        # None is returned for the URLs not belonging to any of the services
+        return self._breakers.get(service)
+
+    def blocked(self):
+        return [service for service, breaker in self._breakers.items() if not breaker.allows()]
+
+    def stats(self):
+        return {service: breaker.stats() for service, breaker in self._breakers.items()}
+
+_breakers = ServiceBreakers(('yt', 'sc', 'bc'))
+
+
+#
+# Dedicated thread owning the database connection
+#
+# All the database work is queued and executed by this thread only, so it does not compete with youtube_dl extractions
+# for the default executor. Jobs queued at the same time share a single transaction, each of them is wrapped in its own
+# savepoint so a failing job is rolled back alone.
+#
+class DatabaseWorker(threading.Thread):
+    # maximum number of queued jobs sharing a single transaction
+    _batch_size = 32
+    # number of the most recent jobs latency percentiles are computed from
+    _latency_samples = 1024
+
+    def __init__(self):
+        super().__init__(name='ddmbot-database', daemon=True)
+        self._queue = queue.Queue()
+        self._latencies = collections.deque(maxlen=self._latency_samples)
+        self._job_count = 0
+        self._transaction_count = 0
+
+    def submit(self, func, *, transaction=True):
+        future = concurrent.futures.Future()
+        self._queue.put((func, future, time.monotonic(), transaction))
+        return future
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        percentiles = dict()
+        for percentile in (50, 95, 99):
+            percentiles[percentile] = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] * 1000 \
+                if latencies else 0.0
+        return {'queue_depth': self._queue.qsize(), 'jobs': self._job_count, 'transactions': self._transaction_count,
+                'samples': len(latencies), 'percentiles': percentiles}
+
+    def run(self):
+        _connect()
+        try:
+            pending = None
+            while True:
+                job = pending if pending is not None else self._queue.get()
+                pending = None
+                if job is None:
+                    return
+                if not job[3]:
+                    self._execute_standalone(job)
+                    continue
+                # coalesce the jobs waiting in the queue into a single transaction
+                batch = [job]
+                while len(batch) < self._batch_size:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self._execute(batch)
+                        return
+                    if not job[3]:
+                        # job running outside of a transaction must wait for this batch to finish
+                        pending = job
+                        break
+                    batch.append(job)
+                self._execute(batch)
+        finally:
+            _database.close()
+
+    def _execute(self, batch):
+        results = list()
+        try:
+            with _database.atomic():
+                for func, future, queued, transaction in batch:
+                    if not future.set_running_or_notify_cancel():
+                        results.append(None)
+                        continue
+                    try:
+                        with _database.atomic():
+                            results.append((True, func()))
+                    except Exception as e:
+                        results.append((False, e))
+        except Exception as e:
+            # the commit itself has failed, none of the jobs succeeded
+            log.error('Database transaction failed', exc_info=True)
+            results = [None if index < len(results) and results[index] is None else (False, e)
+                       for index in range(len(batch))]
+
+        # futures are resolved only after the transaction is committed
+        self._transaction_count += 1
+        for job, result in zip(batch, results):
+            self._finish(job, result)
+
+    def _execute_standalone(self, job):
+        func, future, queued, transaction = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = (True, func())
+        except Exception as e:
+            result = (False, e)
+        self._finish(job, result)
+
+    def _finish(self, job, result):
+        func, future, queued, transaction = job
+        self._job_count += 1
+        self._latencies.append(time.monotonic() - queued)
+        if result is None:
+            return
+        if result[0]:
+            future.set_result(result[1])
+        else:
+            future.set_exception(result[1])
+
+_worker = None
+
+
+#
+# Pool of threads with read-only connections
+#
+# The database runs in the WAL mode, so readers see the last committed state and are never blocked by the writer.
+#
+class DatabaseReaderPool:
+    def __init__(self, size):
+        self._queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, name='ddmbot-database-reader-{}'.format(index),
+                                          daemon=True) for index in range(size)]
+
+    @property
+    def size(self):
+        return len(self._threads)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, func):
+        future = concurrent.futures.Future()
+        self._queue.put((func, future))
+        return future
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        _connect()
+        _database.execute_sql('PRAGMA query_only = ON;')
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                func, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func())
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            _database.close()
+
+_readers = None
+
+
 class DBInterface:
     def __init__(self, loop):
         if _database.is_closed():
             raise RuntimeError('Database must be initialized and opened before instantiating interfaces')
         self._loop = loop
         self._database = _database
+        self._autoplaylist = _autoplaylist
+        self._credits = _credits
+        self._user_cache = _user_cache
+        self._extractor_cache = _extractor_cache
+        self._breakers = _breakers
+
+    @staticmethod
+    def get_worker_stats():
+        stats = _worker.stats()
+        stats['readers'] = _readers.size
+        stats['reader_queue_depth'] = _readers.queue_depth
+        return stats
 
 
-# decorator for DBInterface methods
+# decorator for DBInterface methods, method is executed by the database worker thread
 def in_executor(method):
     def wrapped_method(self, *args, **kwargs):
         func = functools.partial(method, self, *args, **kwargs)
-        return self._loop.run_in_executor(None, func)
+        return asyncio.wrap_future(_worker.submit(func), loop=self._loop)
+
+    return wrapped_method
+
+
+# decorator for DBInterface methods that cannot run inside a transaction (e.g. checkpoints), executed by the worker
+def in_executor_standalone(method):
+    def wrapped_method(self, *args, **kwargs):
+        func = functools.partial(method, self, *args, **kwargs)
+        return asyncio.wrap_future(_worker.submit(func, transaction=False), loop=self._loop)
+
+    return wrapped_method
+
+
+# decorator for read-only DBInterface methods, method is executed by one of the reader threads
+def in_reader(method):
+    def wrapped_method(self, *args, **kwargs):
+        func = functools.partial(method, self, *args, **kwargs)
+        return asyncio.wrap_future(_readers.submit(func), loop=self._loop)
 
     return wrapped_method
 
@@ -135,8 +1024,73 @@ class DBSongUtil:
                  'sc': 'https://soundcloud.com/{}/{}',
                  'bc': 'https://{}.bandcamp.com/track/{}'}
 
-    _ytdl = youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'format': 'bestaudio/best', 'quiet': True,
-                                  'no_color': True})
+    # shared extractor.Extractor service, set by the classes doing the extraction
+    _extractor = None
+
+    async def _extract_info(self, url, fields, *, key=None, cached=True, lane='interactive', **kwargs):
+        # results are cached under the given key (unique URI for the songs) or the URL itself
+        key = key or url
+        if cached:
+            info = _extractor_cache.lookup(await self._get_cached_info(key), fields)
+            if info is not None:
+                return info
+
+        # songs are subject to the circuit breaker of their service, only the playback lane feeds it -- bulk imports
+        # and validation of the dead links must not open it, they just respect it
+        service = key.split(':')[0]
+        service_breaker = _breakers.get(service)
+        if service_breaker is not None and \
+                not (service_breaker.acquire() if lane == 'playback' else service_breaker.allows()):
+            raise ServiceUnavailableError('Service {} is temporarily unavailable'.format(service))
+        breaker = service_breaker if lane == 'playback' else None
+
+        # youtube_dl calls take long, they must never block the database worker
+        try:
+            result = await self._extractor.extract_info(url, lane=lane, **kwargs)
+        except TransientExtractionError as e:
+            # network or server side failure, it is not blamed on the song (nor cached)
+            if service_breaker is None:
+                raise
+            if breaker is not None:
+                breaker.record(False)
+            raise ServiceUnavailableError('Service {} is temporarily unavailable: {}'.format(service, e)) from e
+        except youtube_dl.DownloadError as e:
+            # the service responded, the content is not available
+            if breaker is not None:
+                breaker.record(True)
+            await self._store_failure(key, str(e))
+            raise
+        except BaseException:
+            # cancelled or failed for an unrelated reason, the outcome is unknown
+            if breaker is not None:
+                breaker.release()
+            raise
+
+        if breaker is not None:
+            breaker.record(True)
+        await self._store_info(key, result)
+        return result
+
+    @in_reader
+    def _get_cached_info(self, key):
+        try:
+            return ExtractorCache.select(ExtractorCache.fields, ExtractorCache.failure, ExtractorCache.failed) \
+                .where(ExtractorCache.key == key).tuples().get()
+        except ExtractorCache.DoesNotExist:
+            return None
+
+    @in_executor
+    def _store_info(self, key, result):
+        cached_fields = ExtractorCache.select(ExtractorCache.fields).where(ExtractorCache.key == key).scalar()
+        ExtractorCache.insert(key=key, fields=_extractor_cache.merge(cached_fields, result), failure=None,
+                              failed=None, updated=datetime.now()).upsert().execute()
+
+    @in_executor
+    def _store_failure(self, key, message):
+        # cached fields are kept, the failure takes precedence until it expires
+        if ExtractorCache.update(failure=message, failed=time.time(), updated=datetime.now()) \
+                .where(ExtractorCache.key == key).execute() != 1:
+            ExtractorCache.insert(key=key, failure=message, failed=time.time(), updated=datetime.now()).execute()
 
     @staticmethod
     def _make_url(song_uuri):
@@ -147,6 +1101,13 @@ class DBSongUtil:
     def _is_list(input_url):
         return DBSongUtil._list_regex.match(input_url) is not None
 
+    @staticmethod
+    def _list_entry_urls(result):
+        # flat list entries carry the video id only for youtube, URLs otherwise
+        if result['extractor'] == 'youtube:playlist':
+            return [DBSongUtil._url_base['yt'].format(entry['id']) for entry in result['entries']]
+        return [entry['url'] for entry in result['entries']]
+
     @staticmethod
     def _make_uuri(song_url):
         # makes unique URI from URLs suitable for database storage
@@ -199,29 +1160,226 @@ class DBPlaylistUtil:
 
             return playlist, created
 
+    @staticmethod
+    def _update_counters(playlist, count, duration):
+        # must be called in the same transaction the links are modified in
+        Playlist.update(song_count=Playlist.song_count + count, song_duration=Playlist.song_duration + duration) \
+            .where(Playlist.id == playlist.id).execute()
+        User.update(song_count=User.song_count + count, song_duration=User.song_duration + duration) \
+            .where(User.id == playlist.user_id).execute()
+
+
+#
+# Schema migrations
+#
+# Every migration is applied once, in order, in its own transaction. The version of the schema is stored in the
+# user_version pragma. Migrations must cope with the databases created by create_tables, as fresh databases start at
+# the version 0 as well.
+#
+def _add_missing_columns(table, columns):
+    # plain ALTER TABLE, the peewee migrator rebuilds the table for the NOT NULL columns, which fails on the foreign
+    # keys referencing it (and on the table constraints it cannot parse)
+    existing = [column.name for column in _database.get_columns(table)]
+    for name, definition in columns:
+        if name not in existing:
+            _database.execute_sql('ALTER TABLE "{}" ADD COLUMN "{}" {};'.format(table, name, definition))
+
+
+def _migration_credit_epoch():
+    _add_missing_columns('song', [('credit_epoch', 'INTEGER NOT NULL DEFAULT 0')])
+
+
+def _migration_summary_counters():
+    _add_missing_columns('playlist', [('song_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                      ('song_duration', 'INTEGER NOT NULL DEFAULT 0')])
+    _add_missing_columns('user', [('song_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                  ('song_duration', 'INTEGER NOT NULL DEFAULT 0')])
+    # counters of the existing playlists are filled in right away
+    _database.execute_sql('UPDATE "playlist" SET '
+                          '"song_count" = (SELECT COUNT(*) FROM "link" WHERE "link"."playlist_id" = "playlist"."id"), '
+                          '"song_duration" = (SELECT COALESCE(SUM("song"."duration"), 0) FROM "link" JOIN "song" '
+                          'ON "link"."song_id" = "song"."id" WHERE "link"."playlist_id" = "playlist"."id");')
+    _database.execute_sql('UPDATE "user" SET '
+                          '"song_count" = (SELECT COALESCE(SUM("song_count"), 0) FROM "playlist" '
+                          'WHERE "playlist"."user_id" = "user"."id"), '
+                          '"song_duration" = (SELECT COALESCE(SUM("song_duration"), 0) FROM "playlist" '
+                          'WHERE "playlist"."user_id" = "user"."id");')
+
+
+def _migration_hot_query_indexes():
+    # duplicate checks, prepend and pop_id
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS "link_playlist_id_song_id" ON "link" ("playlist_id", "song_id");')
+    # tail lookups when appending and rotating the playlist
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS "link_playlist_id_next_id" ON "link" ("playlist_id", "next_id");')
+    # automatic playlist pool (re)loading
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS "song_autoplaylist" ON "song" ("listener_count") '
+                          'WHERE NOT "is_blacklisted" AND NOT "has_failed" AND "duplicate_id" IS NULL;')
+    # failed song listing and clearing
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS "song_has_failed_duplicate_id" ON "song" ("has_failed", '
+                          '"duplicate_id");')
+
+
+def _migration_last_validated():
+    _add_missing_columns('song', [('last_validated', 'DATETIME')])
+
+
+def _migration_playlist_source():
+    _add_missing_columns('playlist', [('source', 'VARCHAR(255)'), ('synced', 'DATETIME')])
+
+
+_migrations = [
+    ('credit renewal epochs', _migration_credit_epoch),
+    ('playlist summary counters', _migration_summary_counters),
+    ('indexes for the hot queries', _migration_hot_query_indexes),
+    ('song validation timestamps', _migration_last_validated),
+    ('playlist sources', _migration_playlist_source),
+]
+
+
+def _apply_migrations():
+    version = _database.execute_sql('PRAGMA user_version;').fetchone()[0]
+    if version > len(_migrations):
+        raise RuntimeError('Database schema version {} is newer than the supported one'.format(version))
+
+    for version, (description, migration) in enumerate(_migrations[version:], start=version + 1):
+        start_time = time.monotonic()
+        with _database.atomic():
+            migration()
+            _database.execute_sql('PRAGMA user_version = {};'.format(version))
+        log.info('Database migration {} ({}) applied in {:.3f} s'.format(version, description,
+                                                                          time.monotonic() - start_time))
+
+
+#
+# Function looking for the playlist and user summary counters not matching the links, read-only
+#
+# Returns the ids of the playlists and users to be fixed by fix_summary_counters().
+#
+def _find_summary_mismatches():
+    expected = dict()
+    query = Link.select(Link.playlist, peewee.fn.COUNT(Link.id), peewee.fn.SUM(Song.duration)) \
+        .join(Song, on=(Link.song == Song.id)).group_by(Link.playlist).tuples()
+    for playlist_id, song_count, song_duration in query:
+        expected[playlist_id] = (song_count, song_duration or 0)
+
+    playlist_ids = list()
+    user_expected = collections.defaultdict(lambda: (0, 0))
+    query = Playlist.select(Playlist.id, Playlist.user, Playlist.song_count, Playlist.song_duration).tuples()
+    for playlist_id, user_id, song_count, song_duration in query:
+        counters = expected.get(playlist_id, (0, 0))
+        user_counters = user_expected[user_id]
+        user_expected[user_id] = (user_counters[0] + counters[0], user_counters[1] + counters[1])
+        if counters != (song_count, song_duration):
+            playlist_ids.append(playlist_id)
+
+    user_ids = list()
+    query = User.select(User.id, User.song_count, User.song_duration).tuples()
+    for user_id, song_count, song_duration in query:
+        if user_expected.get(user_id, (0, 0)) != (song_count, song_duration):
+            user_ids.append(user_id)
+
+    return playlist_ids, user_ids
+
+
+#
+# Function fixing the summary counters of the given playlists and users, to be run by the worker thread
+#
+# Playlists might have changed since the check, so the counters are computed again from the current links of the given
+# playlists only, users are fixed afterwards from their playlists. Returns the number of counters actually fixed.
+#
+def fix_summary_counters(playlist_ids, user_ids):
+    fixed = 0
+    for playlist_id in playlist_ids:
+        song_count, song_duration = Link.select(peewee.fn.COUNT(Link.id), peewee.fn.SUM(Song.duration)) \
+            .join(Song, on=(Link.song == Song.id)).where(Link.playlist == playlist_id).tuples().get()
+        song_duration = song_duration or 0
+        fixed += Playlist.update(song_count=song_count, song_duration=song_duration) \
+            .where(Playlist.id == playlist_id,
+                   (Playlist.song_count != song_count) | (Playlist.song_duration != song_duration)).execute()
+
+    for user_id in user_ids:
+        song_count, song_duration = Playlist.select(peewee.fn.SUM(Playlist.song_count),
+                                                    peewee.fn.SUM(Playlist.song_duration)) \
+            .where(Playlist.user == user_id).tuples().get()
+        song_count, song_duration = song_count or 0, song_duration or 0
+        fixed += User.update(song_count=song_count, song_duration=song_duration) \
+            .where(User.id == user_id,
+                   (User.song_count != song_count) | (User.song_duration != song_duration)).execute()
+
+    return fixed
+
+
+#
+# Function checking the database integrity, read-only and thus to be run by a reader
+#
+# Returns the number of failed foreign key constrains and the ids of the playlists and users with summary counters to
+# be fixed. Both checks are done in a single transaction so they see the same snapshot of the database.
+#
+def check_integrity():
+    with _database.atomic():
+        failed = len(ForeignKeyCheckModel.raw('PRAGMA foreign_key_check;').execute())
+        playlist_ids, user_ids = _find_summary_mismatches()
+    return failed, playlist_ids, user_ids
+
+
+#
+# Function creating an online backup of the opened database into a given file, blocks the calling thread
+#
+# Database is copied in steps of a given number of pages from a dedicated read-only connection. This connection holds
+# a read transaction for the whole time, so in the WAL mode the backup is a consistent snapshot, it is not restarted
+# by the concurrent writes and the writer is never blocked by it.
+#
+def backup_database(filename, pages, step_delay):
+    source = sqlite3.connect(_database.database, isolation_level=None, check_same_thread=False)
+    target = sqlite3.connect(filename)
+    try:
+        source.execute('PRAGMA query_only = ON;')
+        source.execute('BEGIN;')
+        source.execute('SELECT COUNT(*) FROM sqlite_master;').fetchone()
+        # sleeping between the steps leaves the disk bandwidth to the bot
+        source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(step_delay))
+        source.execute('COMMIT;')
+    finally:
+        target.close()
+        source.close()
+
 
 #
 # Function to initialize and open database connection to a given file
 #
-# Integrity check is performed.
+# Integrity checks are left for the maintenance task, see BotInterface.task_database_maintenance.
 #
-def initialize(filename):
+def initialize(filename, readers, profile):
         if not _database.is_closed():
             raise RuntimeError('Database is opened already')
+        if profile not in _pragma_profiles:
+            raise ValueError('Unknown database pragma profile {}'.format(profile))
 
+        global _pragmas
+        _pragmas = _pragma_profiles[profile]
         _database.init(filename)
-        _database.connect()
-        _database.create_tables([CreditTimestamp, Song, Playlist, Link, User], safe=True)
+        _connect()
+        _database.create_tables([CreditTimestamp, Song, Playlist, Link, User, StatsJournal, PlayHistory, SongRollup,
+                                 UserRollup, ExtractorCache, ImportJob], safe=True)
 
-        # check for the failed foreign key constrains
-        failed_query = ForeignKeyCheckModel.raw('PRAGMA foreign_key_check;')
-        if len(failed_query.execute()):
-            _database.close()
-            raise RuntimeError('Foreign key constrains check failed, database is corrupted and needs to be fixed')
+        _apply_migrations()
+        _credits.load()
+        _user_cache.load()
+
+        # from now on, all the database work is done by the worker thread and the readers
+        global _worker, _readers
+        _worker = DatabaseWorker()
+        _worker.start()
+        _readers = DatabaseReaderPool(readers)
+        _readers.start()
 
 
 #
 # Function taking care of properly closing database
 #
 def close():
+        if _readers is not None:
+            _readers.stop()
+        if _worker is not None and _worker.is_alive():
+            _worker.stop()
         _database.close()
@@ -0,0 +1,48 @@
+from database.common import *
+
+
+#
+# Persistence of the background playlist imports
+#
+# Job rows are created by the command, updated after every processed item and deleted once the job is finished or
+# cancelled. Unfinished jobs are resumed from the stored (already expanded) input after a restart.
+#
+class JobInterface(DBInterface, DBPlaylistUtil):
+    # number of messages kept for the final report, the rest is only counted
+    message_limit = 10
+
+    def __init__(self, loop, config):
+        self._config_user_limit = int(config['import_user_queue_limit'])
+        DBInterface.__init__(self, loop)
+
+    @in_executor
+    def create(self, user_id, playlist_name, prepend, uris):
+        if ImportJob.select().where(ImportJob.user == user_id).count() >= self._config_user_limit:
+            raise RuntimeError('You can have at most {} imports queued, please wait for them to finish or cancel some '
+                               'of them'.format(self._config_user_limit))
+
+        # the target playlist is resolved now, so switching the active playlist does not affect the queued imports
+        playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name, create_default=True)
+        messages = list()
+        if created:
+            messages.append('Since you haven\'t had any playlist, a *default* one was created for you. Note that songs '
+                            'will be removed from it after playing.')
+        return ImportJob.create(user=user_id, playlist=playlist.name, prepend=prepend, uris=json.dumps(uris),
+                                messages=json.dumps(messages), created=datetime.now())
+
+    @in_reader
+    def get_pending(self):
+        return list(ImportJob.select().order_by(ImportJob.id))
+
+    @in_reader
+    def get_user_jobs(self, user_id):
+        return list(ImportJob.select().where(ImportJob.user == user_id).order_by(ImportJob.id))
+
+    @in_executor
+    def update(self, job_id, uris, inserted, failed, messages):
+        ImportJob.update(uris=json.dumps(uris), inserted=inserted, failed=failed,
+                         messages=json.dumps(messages[:self.message_limit + 1])).where(ImportJob.id == job_id).execute()
+
+    @in_executor
+    def delete(self, job_id):
+        return ImportJob.delete().where(ImportJob.id == job_id).execute()
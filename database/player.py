@@ -18,6 +18,18 @@ class UnavailableSongError(Exception):
         return self._song_title
 
 
+# Raised when none of the songs in the playlist can be played at the moment (overplayed, blacklisted, too long)
+class NoEligibleSongError(Exception):
+    def __init__(self, *args, state=None):
+        super().__init__(*args)
+        self._state = state
+
+    @property
+    def state(self):
+        # identifies the playlist content, DJ is notified again only if it changes
+        return self._state
+
+
 class SongContext:
     __slots__ = ['_dj', '_song', '_title', '_duration', '_url', '_skip_voters', '_all_listeners', '_current_listeners']
 
@@ -73,128 +85,182 @@ class SongContext:
         self._skip_voters.add(user_id)
 
 
-class PlayerInterface(DBInterface, DBSongUtil):
-    def __init__(self, loop, config):
-        self._config_ap_threshold = int(config['ap_threshold'])
-        self._config_ap_ratio = float(config['ap_skip_ratio'])
+class PlayerInterface(DBInterface, DBPlaylistUtil, DBSongUtil):
+    # how many songs picked from the automatic playlist pool may turn out to be ineligible
+    _pick_attempts = 5
+
+    def __init__(self, loop, config, extractor):
         self._config_max_duration = int(config['song_length_limit'])
         self._config_op_interval = int(config['op_interval'])
         DBInterface.__init__(self, loop)
+        self._extractor = extractor
 
-    @in_executor
-    def get_next_song(self, user_id):
-        song = None
-        with self._database.atomic():
-            # check if there is an associated playlist
-            try:
-                playlist = Playlist.select(Playlist.id, Playlist.head, Playlist.repeat) \
-                    .join(User, on=(User.active_playlist == Playlist.id)).where(User.id == user_id).get()
-            except Playlist.DoesNotExist as e:
-                raise LookupError('You don\'t have an active playlist') from e
-
-            if playlist.head is None:
-                raise LookupError('Your playlist is empty')
-
-            # join song link and song tables to obtain a result
-            link = Link.select(Link, Song).join(Song).where(Link.id == playlist.head).get()
-            song = link.song
+    async def get_next_song(self, user_id):
+        # ineligible songs are skipped by the database query already
+        link_id, song = await self._get_next_link(user_id)
 
-            # now check if the link should be re-appended or deleted, update the pointers
-            if not playlist.repeat:
-                # update next song "pointer", should work in any situation
-                Playlist.update(head=link.next_id).where(Playlist.id == playlist.id).execute()
-                # delete the link
-                link.delete_instance()
-            elif link.next_id is not None:  # we should repeat and playlist does consist of multiple songs
-                # update next song "pointer"
-                Playlist.update(head=link.next_id).where(Playlist.id == playlist.id).execute()
-                # append the link at the end
-                Link.update(next=link.id).where(Link.next >> None, Link.playlist == playlist.id).execute()
-                Link.update(next=None).where(Link.id == link.id, Link.playlist == playlist.id).execute()
-
-            # check duplicate song flag and do the replacement if necessary
-            if song.duplicate_id is not None:
-                song = song.duplicate
-
-        # check the constrains
-        # -- blacklist
-        if song.is_blacklisted:
-            raise RuntimeError('Song [{}] was blacklisted by an operator'.format(song.id))
-        # -- last played
-        time_diff = datetime.now() - song.last_played
-        if time_diff.total_seconds() < self._config_op_interval:
-            raise RuntimeError('Song [{}] has been played recently'.format(song.id))
-        # -- credits remaining
-        if song.credit_count == 0:
-            raise RuntimeError('Song [{}] is overplayed'.format(song.id))
-        # -- check the song length
-        if song.duration > self._config_max_duration:
-            raise RuntimeError('Song [{}]\'s length exceeds the limit'.format(song.id))
-
-        # fetch the URL using youtube_dl
+        # fetch the URL using youtube_dl, the link is left in place if the service is unavailable
         try:
-            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
+            result = await self._extract_info(self._make_url(song.uuri), ('url',), key=song.uuri, lane='playback')
         except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
+            await self._consume_link(link_id)
             if not song.has_failed:
                 log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
-                Song.update(has_failed=True).where(Song.id == song.id).execute()
+                await self._set_failed(song.id, True)
             raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
                                        song_title=song.title) from e
+        await self._consume_link(link_id)
 
         # there is a chance song was marked as failed before but it no longer applies, fix the flag
         if song.has_failed:
             log.info('Failed flag was removed from the song [{}] after a successful download'.format(song.id))
-            Song.update(has_failed=False).where(Song.id == song.id).execute()
+            await self._set_failed(song.id, False)
 
         return SongContext(user_id, song.id, song.title, song.duration, result['url'])
 
-    @in_executor
-    def get_autoplaylist_song(self):
-        reference_time = datetime.now() - timedelta(seconds=self._config_op_interval)
-        query = Song.select(Song).where(
-            Song.last_played < reference_time,  # overplay protection interval
-            Song.listener_count >= self._config_ap_threshold,  # listener threshold
-            Song.skip_vote_count < peewee.Passthrough(self._config_ap_ratio) * Song.listener_count,  # skip ratio
-            Song.duration <= self._config_max_duration,  # song duration
-            Song.credit_count > 0,  # overplay protection
-            ~Song.is_blacklisted,  # cannot be blacklisted
-            ~Song.has_failed,  # probably unavailable
-            Song.duplicate >> None  # not fair + outdated information
-        ).order_by(peewee.fn.Random())
-
-        try:
-            song = query.get()
-        except Song.DoesNotExist:
+    async def get_autoplaylist_song(self):
+        # pool is normally loaded by BotInterface.task_autoplaylist_check already, but the player can be faster
+        if not self._autoplaylist.loaded:
+            await self._load_autoplaylist()
+        song = await self._pick_autoplaylist_song()
+        if song is None:
             # there is no song conforming to the automatic playlist conditions
             return None
 
         try:
-            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
+            result = await self._extract_info(self._make_url(song.uuri), ('url',), key=song.uuri, lane='playback')
         except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
             log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
-            Song.update(has_failed=True).where(Song.id == song.id).execute()
+            await self._set_failed(song.id, True)
             raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
                                        song_title=song.title) from e
         return SongContext(None, song.id, song.title, song.duration, result['url'])
 
+    async def get_stream_info(self, url):
+        return await self._extract_info(url, ('url',), lane='playback')
+
     @in_executor
     def update_stats(self, song_ctx: SongContext):
         current_time = datetime.now()
+        epoch = self._credits.epoch(current_time)
         listeners, skip_voters = song_ctx.get_final_sets()
         # update a song in the database -- listener and skip count, last played, credit count
+        # this must be done right away to ensure proper functionality of overplaying protection
         song_query = Song.update(listener_count=Song.listener_count + len(listeners),
                                  skip_vote_count=Song.skip_vote_count + len(skip_voters),
-                                 last_played=current_time, credit_count=Song.credit_count - 1) \
+                                 last_played=current_time, credit_count=self._credits.expression(epoch) - 1,
+                                 credit_epoch=epoch) \
             .where(Song.id == song_ctx.song_id)
-        # update the dj in the database -- play count
-        dj_query = User.update(play_count=User.play_count + 1).where(User.id == song_ctx.dj_id)
-        # update the listeners in the database -- listen count
-        condition = User.id == listeners.pop()
-        while listeners:
-            condition |= User.id == listeners.pop()
-        listener_query = User.update(listen_count=User.listen_count + 1).where(condition)
+        # user statistics are only journaled, BotInterface.task_stats_flush takes care of them
+        journal_query = StatsJournal.insert(song=song_ctx.song_id, dj=song_ctx.dj_id,
+                                            listeners=','.join(str(listener) for listener in listeners),
+                                            skip_vote_count=len(skip_voters), played=current_time)
 
         with self._database.atomic():
             song_query.execute()
-            dj_query.execute()
-            listener_query.execute()
+            journal_query.execute()
+        self._autoplaylist.refresh([song_ctx.song_id])
+
+    #
+    # Internally used methods
+    #
+    @in_reader
+    def _get_next_link(self, user_id):
+        current_time = datetime.now()
+        with self._database.atomic():
+            # check if there is an associated playlist
+            try:
+                playlist = Playlist.select(Playlist.id, Playlist.head, Playlist.song_count) \
+                    .join(User, on=(User.active_playlist == Playlist.id)).where(User.id == user_id).get()
+            except Playlist.DoesNotExist as e:
+                raise LookupError('You don\'t have an active playlist') from e
+
+            if playlist.head is None:
+                raise LookupError('Your playlist is empty')
+
+            # walk the playlist from the head up to the first eligible link, constrains are checked on the original
+            # song if the song is marked as a duplicate (and the original is played)
+            eligibility, params = self._eligibility(current_time)
+            cursor = self._database.execute_sql(
+                'WITH RECURSIVE cte (id, next, song, eligible) AS ('
+                'SELECT link.id, link.next_id, song.id, {0} FROM link {1} WHERE link.id == ? '
+                'UNION ALL '
+                'SELECT link.id, link.next_id, song.id, {0} FROM cte JOIN link ON link.id == cte.next {1} '
+                '  WHERE NOT cte.eligible) '
+                'SELECT id, song, eligible FROM cte;'
+                .format(eligibility, 'JOIN song AS linked ON linked.id == link.song_id '
+                                     'JOIN song ON song.id == COALESCE(linked.duplicate_id, linked.id)'),
+                params + (playlist.head_id,) + params)
+            link_id, song_id, eligible = cursor.fetchall()[-1]
+            if not eligible:
+                raise NoEligibleSongError('There is no song in your playlist that can be played right now',
+                                          state=(playlist.id, playlist.head_id, playlist.song_count))
+
+            return link_id, Song.get(Song.id == song_id)
+
+    @in_executor
+    def _consume_link(self, link_id):
+        # the playlist may have been modified since the link was picked, it is re-read
+        try:
+            link = Link.select(Link.id, Link.playlist, Link.song, Link.next).where(Link.id == link_id).get()
+        except Link.DoesNotExist:
+            return
+        playlist = Playlist.select(Playlist.id, Playlist.user, Playlist.head, Playlist.repeat) \
+            .where(Playlist.id == link.playlist_id).get()
+
+        # now check if the link should be re-appended or deleted, update the pointers
+        if not playlist.repeat:
+            # only the link played is removed, skipped links stay in place
+            if playlist.head_id == link.id:
+                Playlist.update(head=link.next_id).where(Playlist.id == playlist.id).execute()
+            else:
+                Link.update(next=link.next_id).where(Link.next == link.id).execute()
+            Link.delete().where(Link.id == link.id).execute()
+            duration = Song.select(Song.duration).where(Song.id == link.song_id).scalar()
+            self._update_counters(playlist, -1, -duration)
+        elif link.next_id is not None:  # we should repeat and the link is not the last one
+            # rotate the cycle, links from the head up to the played one (inclusive) are moved to the end
+            Link.update(next=playlist.head_id).where(Link.next >> None, Link.playlist == playlist.id).execute()
+            Link.update(next=None).where(Link.id == link.id).execute()
+            Playlist.update(head=link.next_id).where(Playlist.id == playlist.id).execute()
+
+    def _eligibility(self, current_time):
+        # credit cap is irrelevant for the "any credits left" check
+        # timestamps are compared in the format peewee stores them in
+        condition = 'NOT song.is_blacklisted AND song.last_played <= ? AND ' \
+                    'song.credit_count - song.credit_epoch + ? > 0 AND song.duration <= ?'
+        params = (str(current_time - timedelta(seconds=self._config_op_interval)), self._credits.epoch(current_time),
+                  self._config_max_duration)
+        # songs from the services that are unavailable at the moment are skipped as well
+        blocked = self._breakers.blocked()
+        if blocked:
+            condition += ' AND substr(song.uuri, 1, instr(song.uuri, \':\') - 1) NOT IN ({})' \
+                .format(', '.join('?' * len(blocked)))
+            params += tuple(blocked)
+        return '({})'.format(condition), params
+
+    @in_reader
+    def _load_autoplaylist(self):
+        self._autoplaylist.load()
+
+    @in_executor
+    def _pick_autoplaylist_song(self):
+        for _ in range(self._pick_attempts):
+            # songs from the services unavailable at the moment are not picked, the others are preferred instead
+            song_id = self._autoplaylist.pick(self._breakers.blocked())
+            if song_id is None:
+                return None
+            try:
+                song = Song.get(Song.id == song_id)
+            except Song.DoesNotExist:
+                self._autoplaylist.refresh([song_id])
+                continue
+            # the pool should be consistent, but we have to be sure
+            if self._autoplaylist.verify(song):
+                return song
+        return None
+
+    @in_executor
+    def _set_failed(self, song_id, failed):
+        Song.update(has_failed=failed).where(Song.id == song_id).execute()
+        self._autoplaylist.refresh([song_id])
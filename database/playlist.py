@@ -6,25 +6,54 @@ from database.common import *
 
 
 class SongUriProcessor(DBSongUtil):
-    def __init__(self, database, credit_cap, uris, *, reverse=False):
+    def __init__(self, loop, database, extractor, credit_cap, uris, *, reverse=False):
+        self._loop = loop
         self._database = database
+        self._extractor = extractor
         self._credit_cap = credit_cap
         self._uris = deque(uris)
         self._reverse = reverse
+        # bulk imports give way to the single songs added interactively
+        self._lane = 'interactive' if len(uris) == 1 else 'background'
 
-    def __iter__(self):
-        return self
+    def remaining(self):
+        # input not processed yet, with the lists expanded, can be passed to a new processor to continue
+        return list(self._uris)
 
-    def _get_song(self, song_url):
+    @in_executor
+    def _get_song_by_id(self, song_id):
+        try:
+            return Song.get(Song.id == song_id)
+        except Song.DoesNotExist as e:
+            raise RuntimeError('Song [{}] cannot be found in the database'.format(song_id)) from e
+
+    @in_executor
+    def _get_song_by_uuri(self, song_uuri):
+        try:
+            return Song.get(Song.uuri == song_uuri)
+        except Song.DoesNotExist:
+            return None
+
+    @in_executor
+    def _create_song(self, song_uuri, title, duration):
+        # since the song may be about to be added multiple times, check again and insert atomically
+        with self._database.atomic():
+            try:
+                return Song.create(uuri=song_uuri, title=title, last_played=datetime.utcfromtimestamp(0),
+                                   duration=duration, credit_count=self._credit_cap)
+            except peewee.IntegrityError:
+                return Song.get(Song.uuri == song_uuri)
+
+    async def _get_song(self, song_url):
         song_uuri = self._make_uuri(song_url)
         if not song_uuri:
             raise ValueError('Malformed URL or unsupported service')
         # potentially the first query of the song
-        try:
-            song = Song.get(Song.uuri == song_uuri)
-        except Song.DoesNotExist:
+        song = await self._get_song_by_uuri(song_uuri)
+        if song is None:
             # we need to create a new record, youtube_dl is necessary to obtain a title and a song length
-            result = self._ytdl.extract_info(self._make_url(song_uuri), download=False, process=False)
+            result = await self._extract_info(self._make_url(song_uuri), ('title', 'duration'), key=song_uuri,
+                                               lane=self._lane, process=False)
             try:
                 title = result['title']
             except KeyError as e:
@@ -33,39 +62,28 @@ class SongUriProcessor(DBSongUtil):
                 duration = int(result['duration'])
             except (KeyError, ValueError) as e:
                 raise RuntimeError('Failed to extract song duration') from e
-            # since the song may be about to be added multiple times, check again and insert atomically
-            with self._database.atomic():
-                try:
-                    song = Song.create(uuri=song_uuri, title=title, last_played=datetime.utcfromtimestamp(0),
-                                       duration=duration, credit_count=self._credit_cap)
-                except peewee.IntegrityError:
-                    song = Song.get(Song.uuri == song_uuri)
+            song = await self._create_song(song_uuri, title, duration)
         return song
 
-    def __next__(self):
-        # get a new item
+    async def next_song(self):
+        # get a new item, None is returned when there are no more items
         try:
             uri = self._uris.pop() if self._reverse else self._uris.popleft()
-        except IndexError as e:
-            raise StopIteration from e
+        except IndexError:
+            return None
         # check if song id
         if uri.isdigit():
-            try:
-                return Song.get(Song.id == int(uri))
-            except Song.DoesNotExist as e:
-                raise RuntimeError('Song [{}] cannot be found in the database'.format(uri)) from e
+            return await self._get_song_by_id(int(uri))
         # it can be a list otherwise
         if self._is_list(uri):
             try:
-                result = self._ytdl.extract_info(uri, download=False)
+                result = await self._extract_info(uri, ('extractor', 'entries'), lane=self._lane)
                 if 'entries' not in result:
                     raise RuntimeError('Malformed URL or unsupported service')
                 # create a new uri list from the results
-                if result['extractor'] == 'youtube:playlist':
-                    list_uris = [self._url_base['yt'].format(entry['id']) for entry in result['entries']]
-                else:
-                    list_uris = [entry['url'] for entry in result['entries']]
-                # put back most of them and keep the first one
+                list_uris = self._list_entry_urls(result)
+                # put back most of them and keep the first one, from now on it is a bulk import
+                self._lane = 'background'
                 if self._reverse:
                     self._uris.extend(list_uris[:-1])
                     uri = list_uris[-1]
@@ -76,19 +94,23 @@ class SongUriProcessor(DBSongUtil):
                 raise RuntimeError('Processing `{}` failed: {}'.format(uri, str(e))) from e
         # now we have a single song, hopefully at least
         try:
-            return self._get_song(uri)
+            return await self._get_song(uri)
         except Exception as e:
             raise RuntimeError('Processing `{}` failed: {}'.format(uri, str(e))) from e
 
 
 class PlaylistInterface(DBInterface, DBPlaylistUtil):
-    def __init__(self, loop, config):
+    # supported orders for the reorder method
+    _orders = ('shuffle', 'title', 'duration', 'reverse')
+
+    def __init__(self, loop, config, extractor):
         self._config_max_playlists = int(config['playlist_count_limit'])
         self._config_max_songs = int(config['song_count_limit'])
         self._config_op_credit_cap = int(config['op_credit_cap'])
         DBInterface.__init__(self, loop)
+        self._extractor = extractor
 
-    @in_executor
+    @in_reader
     def exists(self, user_id, playlist_name):
         try:
             self._get_playlist(user_id, playlist_name)
@@ -96,7 +118,7 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
             return False
         return True
 
-    @in_executor
+    @in_reader
     def get_active(self, user_id):
         try:
             playlist = Playlist.select(Playlist).join(User, on=(User.active_playlist == Playlist.id)) \
@@ -136,23 +158,23 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
 
             Playlist.update(head=None).where(Playlist.id == playlist.id).execute()
             Link.delete().where(Link.playlist == playlist.id).execute()
+            self._update_counters(playlist, -playlist.song_count, -playlist.song_duration)
 
         return playlist.name
 
-    @in_executor
+    @in_reader
     def list(self, user_id):
-        query = Playlist.select(Playlist.name, peewee.fn.COUNT(Link.id).alias('song_count'), Playlist.repeat) \
-            .join(Link, join_type=peewee.JOIN_LEFT_OUTER, on=(Link.playlist == Playlist.id)) \
-            .where(Playlist.user == user_id).group_by(Playlist.name)
+        query = Playlist.select(Playlist.name, Playlist.song_count, Playlist.song_duration, Playlist.repeat,
+                                Playlist.source).where(Playlist.user == user_id).order_by(Playlist.name)
 
         return list(query.dicts())
 
-    @in_executor
+    @in_reader
     def show(self, user_id, offset, limit, playlist_name):
         with self._database.atomic():
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
 
-            total = Link.select().where(Link.playlist == playlist.id).count()
+            total = playlist.song_count
             query = Song.raw('WITH RECURSIVE cte (id, title, next) AS ('
                              'SELECT song.id, song.title, link.next_id FROM song JOIN link ON song.id == link.song_id '
                              '  WHERE link.id == ? '
@@ -165,18 +187,41 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
         return songs, playlist.name, total
 
     @in_executor
-    def shuffle(self, user_id, playlist_name):
+    def reorder(self, user_id, order, playlist_name):
+        if order not in self._orders:
+            raise ValueError('Unknown playlist order {}, valid options are: {}'.format(order, ', '.join(self._orders)))
+
         with self._database.atomic():
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
-            query = Link.select().where(Link.playlist == playlist.id)
-            song_list = list()
-
-            for item in query:
-                song_list.append(item.song_id)
-            random.shuffle(song_list)
-            for item, new_id in zip(query, song_list):
-                item.song_id = new_id
-                item.save()
+            if playlist.head_id is None:
+                return playlist.name
+
+            # fetch the whole playlist in its current order with a single query
+            cursor = self._database.execute_sql(
+                'WITH RECURSIVE cte (id, title, duration, next) AS ('
+                'SELECT link.id, song.title, song.duration, link.next_id FROM song JOIN link '
+                '  ON song.id == link.song_id WHERE link.id == ? '
+                'UNION ALL '
+                'SELECT link.id, song.title, song.duration, link.next_id FROM cte, song JOIN link '
+                '  ON song.id == link.song_id WHERE link.id == cte.next) '
+                'SELECT id, title, duration FROM cte;', (playlist.head_id,))
+            links = cursor.fetchall()
+
+            # sorting is stable, songs with equal keys keep their relative order
+            if order == 'shuffle':
+                random.shuffle(links)
+            elif order == 'title':
+                links.sort(key=lambda link: link[1].lower())
+            elif order == 'duration':
+                links.sort(key=lambda link: link[2])
+            elif order == 'reverse':
+                links.reverse()
+
+            # rewrite the next pointers with a single prepared statement
+            link_ids = [link[0] for link in links]
+            self._database.get_cursor().executemany('UPDATE "link" SET "next_id" = ? WHERE "id" = ?',
+                                                    zip(link_ids[1:] + [None], link_ids))
+            Playlist.update(head=link_ids[0]).where(Playlist.id == playlist.id).execute()
 
         return playlist.name
 
@@ -186,6 +231,7 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
             User.update(active_playlist=None).where(User.id == user_id, User.active_playlist == playlist.id).execute()
             Link.delete().where(Link.playlist == playlist.id).execute()
+            self._update_counters(playlist, -playlist.song_count, -playlist.song_duration)
             playlist.delete_instance()
 
         return playlist.name
@@ -199,17 +245,60 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
         return playlist.name
 
     @in_executor
-    def insert(self, user_id, playlist_name, prepend, uris):
+    def link(self, user_id, source, playlist_name):
+        if source is not None and not self._is_list(source):
+            raise ValueError('Only Youtube playlists, Soundcloud sets and Bandcamp albums can be linked')
+
+        with self._database.atomic():
+            playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
+            Playlist.update(source=source, synced=None).where(Playlist.id == playlist.id).execute()
+
+        return playlist.name
+
+    async def sync(self, user_id, playlist_name, *, lane='interactive'):
+        # returns the URLs of the songs from the remote list missing in the playlist, a single extraction is needed
+        playlist = await self._get_sync_playlist(user_id, playlist_name)
+        if playlist.source is None:
+            raise LookupError('Playlist {} is not linked to any remote playlist'.format(playlist.name))
+
+        # failed attempts count too, unavailable lists are not retried until the next period
+        await self._set_synced(playlist.id)
+        result = await self._extract_info(playlist.source, ('extractor', 'entries'), cached=False, lane=lane)
+        if 'entries' not in result:
+            raise RuntimeError('Remote playlist of {} cannot be processed'.format(playlist.name))
+        urls = self._list_entry_urls(result)
+
+        # entries the URI cannot be made for are always processed, insert reports them if present already
+        present = await self._get_linked_uuris(playlist.id)
+        missing = list()
+        for url in urls:
+            uuri = self._make_uuri(url)
+            if uuri is None or uuri not in present:
+                missing.append(url)
+                present.add(uuri)
+
+        return playlist.name, missing
+
+    @in_reader
+    def get_stale_sources(self, synced_before):
+        return list(Playlist.select(Playlist.user, Playlist.name)
+                    .where(Playlist.source.is_null(False),
+                           (Playlist.synced >> None) | (Playlist.synced < synced_before)).tuples())
+
+    async def insert(self, user_id, playlist_name, prepend, uris, *, progress=None):
+        # progress coroutine is awaited after every item with a function returning the remaining input (copied, so it
+        # is only called when needed), counters and messages so far
         # we will return a log of messages
         messages = list()
 
         # get a playlist
-        playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name, create_default=True)
+        playlist, created = await self._get_insert_playlist(user_id, playlist_name)
         if created:
             messages.append('Since you haven\'t had any playlist, a *default* one was created for you. Note that songs '
                             'will be removed from it after playing.')
         # construct some iterator object from uris
-        song_list = SongUriProcessor(self._database, self._config_op_credit_cap, uris, reverse=prepend)
+        song_list = SongUriProcessor(self._loop, self._database, self._extractor, self._config_op_credit_cap, uris,
+                                     reverse=prepend)
 
         # compose "already present message"
         present_message = 'The song [{}] {} was already present in your playlist.'
@@ -222,19 +311,21 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
         while True:
             # get a next song to append
             try:
-                song = next(song_list)
-            except StopIteration:
-                return playlist.name, inserted, failed, False, messages
+                song = await song_list.next_song()
             except Exception as e:
                 # append an error to the list
                 messages.append(str(e))
                 failed += 1
+                if progress is not None:
+                    await progress(song_list.remaining, inserted, failed, messages)
                 continue
+            if song is None:
+                return playlist.name, inserted, failed, False, messages
 
             # now insert it
             try:
-                result = self._prepend_song(user_id, song.id, playlist.name) if prepend \
-                    else self._append_song(user_id, song.id, playlist.name)
+                result = await self._prepend_song(user_id, song, playlist.name) if prepend \
+                    else await self._append_song(user_id, song, playlist.name)
 
                 if result:
                     inserted += 1
@@ -246,6 +337,9 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
                 failed += 1
                 return playlist.name, inserted, failed, True, messages
 
+            if progress is not None:
+                await progress(song_list.remaining, inserted, failed, messages)
+
     @in_executor
     def pop(self, user_id, count, playlist_name):
         if count <= 0:
@@ -256,15 +350,19 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
 
             deleted = 0
+            duration = 0
             # remove *count* links
             current_link = playlist.head_id
             while deleted < count and current_link is not None:
-                next_link = Link.select(Link.next).where(Link.id == current_link).get().next_id
+                next_link, song_duration = Link.select(Link.next, Song.duration).join(Song) \
+                    .where(Link.id == current_link).tuples().get()
                 Link.delete().where(Link.id == current_link).execute()
                 current_link = next_link
                 deleted += 1
+                duration += song_duration
             # update the playlist head
             Playlist.update(head=current_link).where(Playlist.id == playlist.id).execute()
+            self._update_counters(playlist, -deleted, -duration)
 
         return playlist.name, deleted
 
@@ -276,7 +374,8 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
 
             # find the target link
             try:
-                target_link = Link.get(Link.playlist == playlist.id, Link.song == song_id)
+                target_link = Link.select(Link, Song).join(Song) \
+                    .where(Link.playlist == playlist.id, Link.song == song_id).get()
             except Link.DoesNotExist as e:
                 raise LookupError('Specified song was not found in your playlist') from e
 
@@ -290,27 +389,44 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
 
             # finally, delete the target link
             target_link.delete_instance()
+            self._update_counters(playlist, -1, -target_link.song.duration)
 
         return playlist.name
 
     #
     # Internally used methods
     #
-    def _append_song(self, user_id, song_id, playlist_name):
+    @in_reader
+    def _get_sync_playlist(self, user_id, playlist_name):
+        return self._get_playlist_ex(user_id, playlist_name=playlist_name)[0]
+
+    @in_reader
+    def _get_linked_uuris(self, playlist_id):
+        query = Song.select(Song.uuri).join(Link, on=(Link.song == Song.id)).where(Link.playlist == playlist_id)
+        return {uuri for uuri, in query.tuples()}
+
+    @in_executor
+    def _set_synced(self, playlist_id):
+        Playlist.update(synced=datetime.now()).where(Playlist.id == playlist_id).execute()
+
+    @in_executor
+    def _get_insert_playlist(self, user_id, playlist_name):
+        return self._get_playlist_ex(user_id, playlist_name=playlist_name, create_default=True)
+
+    @in_executor
+    def _append_song(self, user_id, song, playlist_name):
         with self._database.atomic():
             # get a playlist
             playlist = self._get_playlist(user_id, playlist_name)
 
             # check for duplicates, if present just return
-            if Link.select().where(Link.playlist == playlist.id, Link.song == song_id).count():
+            if Link.select().where(Link.playlist == playlist.id, Link.song == song.id).count():
                 return False
             # check for the song count limit
-            count = Link.select().join(Playlist, on=(Link.playlist == Playlist.id)).where(Playlist.user == user_id) \
-                .count()
-            if count >= self._config_max_songs:
-                raise RuntimeError('You\'ve reached the song count limit for your playlists')
+            self._check_song_limit(user_id)
             # insert a new link
-            link = Link.create(playlist=playlist.id, song=song_id, next=None)
+            link = Link.create(playlist=playlist.id, song=song.id, next=None)
+            self._update_counters(playlist, 1, song.duration)
             # modify the previous link to point to the new one
             if playlist.head_id is None:
                 Playlist.update(head=link.id).where(Playlist.id == playlist.id).execute()
@@ -319,14 +435,15 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
                                                 Link.next >> None, Link.id != link.id).execute()
             return True
 
-    def _prepend_song(self, user_id, song_id, playlist_name):
+    @in_executor
+    def _prepend_song(self, user_id, song, playlist_name):
         with self._database.atomic():
             # get a playlist
             playlist = self._get_playlist(user_id, playlist_name)
 
             try:
                 # if there is a duplicate, we won't insert a new link
-                duplicate = Link.get(Link.playlist == playlist.id, Link.song == song_id)
+                duplicate = Link.get(Link.playlist == playlist.id, Link.song == song.id)
                 # we will reuse the link and push it to the front
                 if Link.update(next=duplicate.next_id).where(Link.next == duplicate.id).execute():
                     # we are not the first link if the statement above modified something
@@ -335,11 +452,14 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
                 return False
             except Link.DoesNotExist:  # can be only raised by the previous Link.get()
                 # do the "normal insert" -- we need to check for length in this case
-                count = Link.select().join(Playlist, on=(Link.playlist == Playlist.id)) \
-                    .where(Playlist.user == user_id).count()
-                if count >= self._config_max_songs:
-                    raise RuntimeError('You\'ve reached the song count limit for your playlists')
+                self._check_song_limit(user_id)
 
-                link = Link.create(playlist=playlist.id, song=song_id, next=playlist.head_id)
+                link = Link.create(playlist=playlist.id, song=song.id, next=playlist.head_id)
                 Playlist.update(head=link.id).where(Playlist.id == playlist.id).execute()
+                self._update_counters(playlist, 1, song.duration)
                 return True
+
+    def _check_song_limit(self, user_id):
+        count = User.select(User.song_count).where(User.id == user_id).scalar()
+        if count is not None and count >= self._config_max_songs:
+            raise RuntimeError('You\'ve reached the song count limit for your playlists')
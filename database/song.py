@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from database.common import *
 
 
@@ -12,13 +14,15 @@ class SongInterface(DBInterface, DBSongUtil):
     def blacklist(self, song_id):
         if Song.update(is_blacklisted=True).where(Song.id == song_id, ~Song.is_blacklisted).execute() != 1:
             raise ValueError('Song [{}] does not exist or is blacklisted already'.format(song_id))
+        self._autoplaylist.refresh([song_id])
 
     @in_executor
     def permit(self, song_id):  # intentionally kept as an instance method
         if Song.update(is_blacklisted=False).where(Song.id == song_id, Song.is_blacklisted).execute() != 1:
             raise ValueError('Song [{}] does not exist or is not blacklisted'.format(song_id))
+        self._autoplaylist.refresh([song_id])
 
-    @in_executor
+    @in_reader
     def search(self, keywords, limit):
         query = Song.select(Song.id, Song.title)
         for keyword in keywords:
@@ -30,12 +34,22 @@ class SongInterface(DBInterface, DBSongUtil):
             result.append((row.id, row.title))
         return result, total
 
-    @in_executor
+    @in_reader
+    def top(self, span, limit):
+        start = rollup_start(span, datetime.now().date())
+        query = SongRollup.select(SongRollup.song, Song.title, SongRollup.play_count, SongRollup.listener_count) \
+            .join(Song, on=(SongRollup.song == Song.id)).where(SongRollup.span == span, SongRollup.start == start) \
+            .order_by(SongRollup.play_count.desc(), SongRollup.listener_count.desc()).limit(limit).tuples()
+        return start, list(query)
+
+    @in_reader
     def get_info(self, song_id):
         try:
             result = Song.select().where(Song.id == song_id).dicts().get()
         except Song.DoesNotExist as e:
             raise ValueError('Song [{}] cannot be found in the database'.format(song_id)) from e
+        # replace the stored credit count with the current one
+        result['credit_count'] = self._credits.count(result['credit_count'], result.pop('credit_epoch'))
         # put url instead of unique uri into the result dictionary
         result['url'] = self._make_url(result.pop('uuri'))
         # remove duplicated_id
@@ -69,6 +83,7 @@ class SongInterface(DBInterface, DBSongUtil):
             # this is effectively a "split" call
             if Song.update(duplicate=None).where(Song.id == source_id).execute() != 1:
                 raise ValueError('Song [{}] cannot be found in the database'.format(source_id))
+            self._autoplaylist.refresh([source_id])
         else:
             with self._database.atomic():
                 try:
@@ -86,15 +101,21 @@ class SongInterface(DBInterface, DBSongUtil):
                 if Song.update(duplicate=target_id).where(
                                 (Song.id == source_id) | (Song.duplicate == source_id)).execute() == 0:
                     raise ValueError('Song [{}] cannot be found in the database'.format(source_id))
+            self._autoplaylist.refresh([source_id, target_id])
 
     @in_executor
     def rename(self, song_id, new_title):
         if Song.update(title=new_title).where(Song.id == song_id).execute() != 1:
             raise ValueError('Song [{}] cannot be found in the database'.format(song_id))
 
-    @in_executor
+    @staticmethod
+    def _failed_query():
+        # equality terms on both the columns, so the song_has_failed_duplicate_id index is used
+        return Song.select(Song.id, Song.title).where(Song.has_failed == True, Song.duplicate >> None)
+
+    @in_reader
     def list_failed(self, limit):
-        query = Song.select(Song.id, Song.title).where(Song.has_failed, Song.duplicate >> None)
+        query = self._failed_query()
         total = query.count()
         result = list()
         for song in query.limit(limit):
@@ -108,6 +129,9 @@ class SongInterface(DBInterface, DBSongUtil):
             # apply only to a song specified
             if query.where(Song.id == song_id).execute() != 1:
                 raise ValueError('Song [{}] cannot be found in the database'.format(song_id))
+            self._autoplaylist.refresh([song_id])
         else:
-            # clear the flag for all the songs
-            query.where(Song.duplicate >> None).execute()
+            # clear the flag for all the songs, only these are refreshed in the automatic playlist pool
+            song_ids = [song.id for song in self._failed_query()]
+            query.where(Song.has_failed == True, Song.duplicate >> None).execute()
+            self._autoplaylist.refresh(song_ids)
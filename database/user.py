@@ -2,7 +2,7 @@ from database.common import *
 
 
 class UserInterface(DBInterface):
-    @in_executor
+    @in_reader
     def info(self, user_id):
         # interesting info: play count, number of playlists, number of songs and if user is blacklisted
         try:
@@ -10,13 +10,22 @@ class UserInterface(DBInterface):
         except User.DoesNotExist as e:
             raise ValueError('User is not in the database') from e
 
-        with self._database.atomic():
-            playlist_count = Playlist.select().where(Playlist.user == user_id).count()
-            song_count = Link.select().join(Playlist, on=(Link.playlist == Playlist.id)) \
-                .where(Playlist.user == user.id).count()
+        playlist_count = Playlist.select().where(Playlist.user == user_id).count()
 
         return {'play_count': user.play_count, 'listen_count': user.listen_count, 'playlist_count': playlist_count,
-                'song_count': song_count, 'ignored': user.is_ignored}
+                'song_count': user.song_count, 'song_duration': user.song_duration, 'ignored': user.is_ignored}
+
+    @in_reader
+    def history(self, user_id, limits):
+        # rollups are read for each span separately, newest first
+        result = dict()
+        for span in ROLLUP_SPANS:
+            query = UserRollup.select(UserRollup.start, UserRollup.play_count, UserRollup.listen_count,
+                                      UserRollup.last_played) \
+                .where(UserRollup.user == user_id, UserRollup.span == span) \
+                .order_by(UserRollup.start.desc()).limit(limits[span]).tuples()
+            result[span] = list(query)
+        return result
 
     @in_executor
     def ignore(self, user_id):
@@ -28,8 +37,10 @@ class UserInterface(DBInterface):
             if user.is_ignored:
                 raise ValueError('User is on the ignore list already')
             User.update(is_ignored=True).where(User.id == user_id).execute()
+        self._user_cache.set_ignored(user_id, True)
 
     @in_executor
     def grace(self, user_id):
         if User.update(is_ignored=False).where(User.id == user_id, User.is_ignored).execute() != 1:
             raise ValueError('User is not on the ignore list')
+        self._user_cache.set_ignored(user_id, False)
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from database.common import *
+
+
+#
+# Background validation of the song availability
+#
+# Songs are re-checked in batches, songs in the active playlists first, then the songs ordered by the listener count
+# (automatic playlist candidates). Requests to each service are rate-limited and only one request is in flight at a
+# time, leaving the executor threads to the player.
+#
+class ValidatorInterface(DBInterface, DBSongUtil):
+    def __init__(self, loop, config, extractor):
+        self._config_period = timedelta(hours=int(config['validator_period']))
+        self._config_batch_size = int(config['validator_batch_size'])
+        self._config_interval = float(config['validator_interval'])
+        self._config_idle_period = int(config['validator_idle_period'])
+        DBInterface.__init__(self, loop)
+        self._extractor = extractor
+
+        # time of the next request allowed for each of the services
+        self._next_request = dict()
+        # statistics, checked and available songs are counted per service
+        self._checked = Counter()
+        self._available = Counter()
+        self._flagged = 0
+        self._cleared = 0
+        self._updated = 0
+        self._remaining = 0
+
+    def stats(self):
+        return {'checked': sum(self._checked.values()), 'flagged': self._flagged, 'cleared': self._cleared,
+                'updated': self._updated, 'remaining': self._remaining,
+                'hit_rates': {service: self._available[service] / count for service, count in self._checked.items()}}
+
+    async def task_validate(self):
+        while True:
+            batch, self._remaining = await self._get_batch(self._config_batch_size)
+            if not batch:
+                # everything is validated, wait for the songs to become stale
+                await asyncio.sleep(self._config_idle_period, loop=self._loop)
+                continue
+
+            validated = 0
+            for song_id, uuri, duration, has_failed in batch:
+                service = uuri.split(':')[0]
+                if not self._breakers.get(service).allows():
+                    continue
+                await self._wait_for_service(service)
+                validated += 1
+                try:
+                    result = await self._extract_info(self._make_url(uuri), ('url',), key=uuri, cached=False,
+                                                      lane='background')
+                except youtube_dl.DownloadError:
+                    self._checked[service] += 1
+                    await self._update_song(song_id, True, duration)
+                    if not has_failed:
+                        self._flagged += 1
+                        log.info('Song [{}] was flagged by the validator due to a download error'.format(song_id))
+                    continue
+                except ServiceUnavailableError:
+                    # outages are not blamed on the songs, they are validated once the service is back
+                    continue
+                except Exception:
+                    # the song is left as it is until the next validation period
+                    log.exception('Validation of the song [{}] failed unexpectedly'.format(song_id))
+                    await self._update_song(song_id, has_failed, duration)
+                    continue
+
+                self._checked[service] += 1
+                self._available[service] += 1
+                new_duration = int(result['duration']) if result.get('duration') else duration
+                await self._update_song(song_id, False, new_duration)
+                if has_failed:
+                    self._cleared += 1
+                    log.info('Failed flag was removed from the song [{}] by the validator'.format(song_id))
+                if new_duration != duration:
+                    self._updated += 1
+
+            if not validated:
+                # all the stale songs belong to the services unavailable at the moment
+                await asyncio.sleep(self._config_idle_period, loop=self._loop)
+
+    async def _wait_for_service(self, service):
+        delay = self._next_request.get(service, 0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay, loop=self._loop)
+        self._next_request[service] = time.monotonic() + self._config_interval
+
+    @in_reader
+    def _get_batch(self, limit):
+        stale = (Song.last_validated >> None) | (Song.last_validated < datetime.now() - self._config_period)
+        candidates = Song.select(Song.id, Song.uuri, Song.duration, Song.has_failed) \
+            .where(Song.duplicate >> None, ~Song.is_blacklisted, stale)
+
+        # songs in the active playlists are the most likely to be played soon
+        active = candidates.join(Link, on=(Link.song == Song.id)) \
+            .join(User, on=(User.active_playlist == Link.playlist)).distinct().limit(limit).tuples()
+        batch = list(active)
+        if len(batch) < limit:
+            song_ids = [song[0] for song in batch]
+            query = candidates.order_by(Song.listener_count.desc()).limit(limit).tuples()
+            batch.extend([song for song in query if song[0] not in song_ids][:limit - len(batch)])
+
+        return batch, candidates.count()
+
+    @in_executor
+    def _update_song(self, song_id, failed, duration):
+        song = Song.select(Song.duration).where(Song.id == song_id).get()
+        Song.update(has_failed=failed, duration=duration, last_validated=datetime.now()) \
+            .where(Song.id == song_id).execute()
+        if duration != song.duration:
+            # playlist and user summary counters include the song duration for every link
+            delta = duration - song.duration
+            self._database.execute_sql(
+                'UPDATE "playlist" SET "song_duration" = "song_duration" + ? * (SELECT COUNT(*) FROM "link" '
+                'WHERE "link"."playlist_id" == "playlist"."id" AND "link"."song_id" == ?) '
+                'WHERE "id" IN (SELECT "playlist_id" FROM "link" WHERE "song_id" == ?);',
+                (delta, song_id, song_id))
+            self._database.execute_sql(
+                'UPDATE "user" SET "song_duration" = "song_duration" + ? * (SELECT COUNT(*) FROM "link" '
+                'JOIN "playlist" ON "playlist"."id" == "link"."playlist_id" '
+                'WHERE "playlist"."user_id" == "user"."id" AND "link"."song_id" == ?) '
+                'WHERE "id" IN (SELECT "user_id" FROM "playlist" JOIN "link" '
+                'ON "link"."playlist_id" == "playlist"."id" WHERE "link"."song_id" == ?);',
+                (delta, song_id, song_id))
+        self._autoplaylist.refresh([song_id])
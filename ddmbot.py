@@ -16,7 +16,10 @@ import discord.ext.commands as dec
 import commandhandler
 import database.bot
 import database.common
+import database.validator
+import extractor
 import helpformatter
+import importer
 import player
 import streamserver
 import usermanager
@@ -91,10 +94,13 @@ class DdmBot:
 
         # future runtime objects -- initialized to None
         self._database = None
+        self._extractor = None
+        self._importer = None
         self._player = None
         self._server = None
         self._stream = None
         self._users = None
+        self._validator = None
 
         self._command_handler = None
 
@@ -116,10 +122,16 @@ class DdmBot:
     def run(self):
         try:
             self._database = database.bot.BotInterface(self._loop, self._config['ddmbot'])
+            self._extractor = extractor.Extractor(self._loop, self._config['ddmbot'])
             self._stream = streamserver.StreamServer(self)
             self._player = player.Player(self)
             self._users = usermanager.UserManager(self)
+            self._importer = importer.Importer(self)
+            self._validator = database.validator.ValidatorInterface(self._loop, self._config['ddmbot'],
+                                                                     self._extractor)
         except:
+            if self._extractor is not None:
+                self._extractor.close()
             self._loop.run_until_complete(self._client.close())
             self._loop.close()
             raise
@@ -129,8 +141,15 @@ class DdmBot:
             self._loop.run_until_complete(self._stream.init())
             self._loop.run_until_complete(self._client.login(self._config['discord']['token']))
 
-            self._bot_task = asyncio.gather(self._database.task_credit_renew(), self._users.task_check_timeouts(),
-                                            self._player.task_player_fsm(), self._client.connect(), loop=self._loop)
+            self._bot_task = asyncio.gather(self._database.task_credit_renew(),
+                                            self._database.task_autoplaylist_check(),
+                                            self._database.task_stats_flush(),
+                                            self._database.task_database_maintenance(),
+                                            self._database.task_database_backup(),
+                                            self._validator.task_validate(), self._importer.task_import(),
+                                            self._importer.task_sync(),
+                                            self._users.task_check_timeouts(), self._player.task_player_fsm(),
+                                            self._client.connect(), loop=self._loop)
 
             try:
                 self._loop.run_until_complete(self._bot_task)
@@ -149,6 +168,7 @@ class DdmBot:
             self._loop.run_until_complete(self._client.logout())
             self._loop.run_until_complete(self._player.cleanup())
             self._loop.run_until_complete(self._stream.cleanup())
+            self._extractor.close()
 
             pending = asyncio.Task.all_tasks()
             for task in pending:
@@ -201,7 +221,7 @@ class DdmBot:
         if message.author == self._client.user:
             return
         # author of the message wrote something, which is kinda a proof (s)he is alive
-        await self._users.refresh_activity(int(message.author.id))
+        self._users.refresh_activity(int(message.author.id))
         # do ignore list pre-check ourselves if this appears to be a command
         if message.content.lstrip().startswith(self._config['ddmbot']['delimiter']):
             with suppress(database.bot.IgnoredUserError):
@@ -289,6 +309,18 @@ class DdmBot:
     def client(self):
         return self._client
 
+    @property
+    def database(self):
+        return self._database
+
+    @property
+    def extractor(self):
+        return self._extractor
+
+    @property
+    def importer(self):
+        return self._importer
+
     @property
     def player(self):
         return self._player
@@ -305,6 +337,10 @@ class DdmBot:
     def users(self):
         return self._users
 
+    @property
+    def validator(self):
+        return self._validator
+
     @property
     def voice(self):
         return self._voice_client
@@ -409,7 +445,9 @@ if __name__ == '__main__':
             # create a ddmbot instance
             ddmbot = DdmBot(arguments.config_file)
             # without a database there is no point in proceeding
-            database.common.initialize(ddmbot.config['ddmbot']['db_file'])
+            database.common.initialize(ddmbot.config['ddmbot']['db_file'],
+                                       int(ddmbot.config['ddmbot']['db_readers']),
+                                       ddmbot.config['ddmbot']['db_profile'])
 
             try:
                 ddmbot.run()
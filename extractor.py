@@ -0,0 +1,248 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import multiprocessing
+import queue
+import signal
+import socket
+import threading
+import time
+import urllib.error
+
+import youtube_dl
+
+# set up the logger
+log = logging.getLogger('ddmbot.extractor')
+
+# fields of the youtube_dl results used by the bot, results are trimmed before leaving the worker process
+_result_fields = ('title', 'description', 'duration', 'extractor', 'url', 'is_live', 'entries')
+
+
+def _trim_result(result):
+    trimmed = {field: result[field] for field in _result_fields if field in result}
+    if 'entries' in trimmed:
+        trimmed['entries'] = [{'id': entry.get('id'), 'url': entry.get('url')} for entry in trimmed['entries']]
+    return trimmed
+
+
+# Raised for the failures not caused by the requested content (network errors, server side errors), which says nothing
+# about the availability of the content itself
+class TransientExtractionError(youtube_dl.DownloadError):
+    pass
+
+
+def _is_transient(error):
+    # youtube_dl wraps the original exception, which in turn may wrap the urllib one
+    exception = error.exc_info[1] if error.exc_info else None
+    while exception is not None:
+        if isinstance(exception, urllib.error.HTTPError):
+            return exception.code == 429 or exception.code >= 500
+        if isinstance(exception, (urllib.error.URLError, socket.timeout, ConnectionError)):
+            return True
+        exception = getattr(exception, 'cause', None) or exception.__cause__
+    return False
+
+
+# Entry point of the worker processes, requests are received and results sent back through the pipe
+def _worker_main(connection):
+    # interrupt is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ytdl = youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'format': 'bestaudio/best', 'quiet': True,
+                                 'no_color': True})
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+
+        url, kwargs = request
+        try:
+            connection.send((True, _trim_result(ytdl.extract_info(url, download=False, **kwargs))))
+        except youtube_dl.DownloadError as e:
+            connection.send((False, 'transient' if _is_transient(e) else 'download', str(e)))
+        except Exception as e:
+            connection.send((False, 'error', '{}: {}'.format(type(e).__name__, e)))
+
+
+class _WorkerProcess:
+    def __init__(self, context):
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=_worker_main, args=(child_connection,), daemon=True)
+        self._process.start()
+        child_connection.close()
+
+    def call(self, url, kwargs, timeout):
+        # blocks the calling thread (but not the interpreter) until the worker responds
+        self._connection.send((url, kwargs))
+        if not self._connection.poll(timeout):
+            raise TimeoutError
+        return self._connection.recv()
+
+    def stop(self):
+        with contextlib.suppress(OSError):
+            self._connection.send(None)
+        self._process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._connection.close()
+
+
+class _ExtractionJob:
+    __slots__ = ['func', 'future', 'lane', 'queued']
+
+    def __init__(self, func, future, lane):
+        self.func = func
+        self.future = future
+        self.lane = lane
+        self.queued = time.monotonic()
+
+
+#
+# Shared youtube_dl service
+#
+# Calls are executed by a pool of warm worker processes, so the CPU-heavy extraction does not hold the interpreter lock
+# of the main process (needed by the audio pacing loops). Hung workers are killed after a timeout and replaced. Each
+# call is waited for by a thread of a dedicated thread pool, blocked in the pipe I/O.
+#
+# Calls are scheduled in lanes -- playback, interactive and background, in the order of priority. A free worker always
+# goes to the highest priority lane with queued calls that is under its concurrency cap, so capping the lower priority
+# lanes below the pool size keeps some workers free for the playback.
+#
+# Concurrent requests for the same URL (and the same options) are coalesced into a single call, its result (or
+# exception) is passed to every waiter. Queued call is promoted if requested through a higher priority lane.
+#
+class Extractor:
+    lanes = ('playback', 'interactive', 'background')
+    # number of queue latency samples kept for every lane
+    _latency_samples = 256
+
+    def __init__(self, loop, config):
+        self._worker_count = int(config['extractor_workers'])
+        self._caps = {lane: int(config['extractor_{}_threads'.format(lane)]) for lane in self.lanes}
+        self._timeout = int(config['extractor_timeout'])
+        self._loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._worker_count)
+
+        # workers are spawned rather than forked, the main process runs threads
+        self._context = multiprocessing.get_context('spawn')
+        self._workers_lock = threading.Lock()
+        self._workers = [_WorkerProcess(self._context) for _ in range(self._worker_count)]
+        self._idle_workers = queue.Queue()
+        for worker in self._workers:
+            self._idle_workers.put(worker)
+        self._timeouts = 0
+
+        self._queues = {lane: collections.deque() for lane in self.lanes}
+        self._running = {lane: 0 for lane in self.lanes}
+        self._latencies = {lane: collections.deque(maxlen=self._latency_samples) for lane in self.lanes}
+        self._in_flight = dict()
+
+        self._calls = 0
+        self._coalesced = 0
+
+    def stats(self):
+        lanes = dict()
+        for lane in self.lanes:
+            latencies = sorted(self._latencies[lane])
+            percentiles = dict()
+            for percentile in (50, 95):
+                percentiles[percentile] = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] * \
+                    1000 if latencies else 0.0
+            lanes[lane] = {'queued': len(self._queues[lane]), 'running': self._running[lane],
+                           'cap': self._caps[lane], 'percentiles': percentiles}
+        return {'calls': self._calls, 'coalesced': self._coalesced, 'in_flight': len(self._in_flight),
+                'timeouts': self._timeouts, 'lanes': lanes}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        with self._workers_lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers.clear()
+
+    async def extract_info(self, url, *, lane='interactive', **kwargs):
+        if lane not in self._queues:
+            raise ValueError('Unknown extractor lane {}'.format(lane))
+
+        key = (url, tuple(sorted(kwargs.items())))
+        job = self._in_flight.get(key)
+        if job is None:
+            func = functools.partial(self._call, url, kwargs)
+            job = _ExtractionJob(func, self._loop.create_future(), lane)
+            self._in_flight[key] = job
+            job.future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            self._queues[lane].append(job)
+            self._calls += 1
+            self._dispatch()
+        else:
+            self._coalesced += 1
+            log.debug('Extraction of {} is in progress already, waiting for the result'.format(url))
+            if self.lanes.index(lane) < self.lanes.index(job.lane) and job in self._queues[job.lane]:
+                self._queues[job.lane].remove(job)
+                job.lane = lane
+                self._queues[lane].append(job)
+                self._dispatch()
+
+        # a waiter being cancelled must not cancel the call for the others
+        return await asyncio.shield(job.future, loop=self._loop)
+
+    def _dispatch(self):
+        while sum(self._running.values()) < self._worker_count:
+            for lane in self.lanes:
+                if self._queues[lane] and self._running[lane] < self._caps[lane]:
+                    break
+            else:
+                return
+
+            job = self._queues[lane].popleft()
+            self._running[lane] += 1
+            self._latencies[lane].append(time.monotonic() - job.queued)
+            call = self._loop.run_in_executor(self._executor, job.func)
+            call.add_done_callback(functools.partial(self._finished, job, lane))
+
+    def _finished(self, job, lane, call):
+        self._running[lane] -= 1
+        if not job.future.done():
+            if call.exception() is not None:
+                job.future.set_exception(call.exception())
+            else:
+                job.future.set_result(call.result())
+        self._dispatch()
+
+    def _call(self, url, kwargs):
+        # executed by the thread pool, the scheduler never runs more calls than there are workers
+        worker = self._idle_workers.get()
+        try:
+            response = worker.call(url, kwargs, self._timeout)
+        except (TimeoutError, EOFError, OSError) as e:
+            # worker is hung or dead, it is replaced by a fresh one
+            worker.kill()
+            with self._workers_lock:
+                self._workers.remove(worker)
+                worker = _WorkerProcess(self._context)
+                self._workers.append(worker)
+            if isinstance(e, TimeoutError):
+                self._timeouts += 1
+                log.warning('Extraction of {} timed out, worker process was killed'.format(url))
+                # says nothing about the content, it is reported to the circuit breaker instead of flagging the song
+                raise TransientExtractionError('Extraction timed out after {} seconds'.format(self._timeout)) from e
+            raise RuntimeError('Extractor worker process died unexpectedly') from e
+        finally:
+            self._idle_workers.put(worker)
+
+        if response[0]:
+            return response[1]
+        if response[1] == 'transient':
+            raise TransientExtractionError(response[2])
+        if response[1] == 'download':
+            raise youtube_dl.DownloadError(response[2])
+        raise RuntimeError(response[2])
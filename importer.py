@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+import discord
+
+import database.job
+import database.playlist
+
+# set up the logger
+log = logging.getLogger('ddmbot.importer')
+
+
+#
+# Background playlist imports
+#
+# Songs are inserted by the jobs running as separate tasks, so the command returns immediately and the extraction
+# (done in the background lane of the extractor) does not block anything else. Every user has at most one job running
+# at a time and the number of jobs running concurrently is capped. Progress is reported by editing a single private
+# message. Jobs are persisted after every processed item, unfinished ones are resumed when the bot starts.
+#
+# Playlists linked to a remote list are synchronized by importing just the songs missing in the playlist.
+#
+class Importer:
+    # delay between the checks for the playlists due to be synchronized [seconds]
+    _sync_check_interval = 600
+    # maximum number of processed items not persisted yet, the job is also persisted every import_progress_interval
+    _checkpoint_items = 50
+
+    def __init__(self, bot):
+        config = bot.config['ddmbot']
+        self._config_job_limit = int(config['import_job_limit'])
+        self._config_progress_interval = float(config['import_progress_interval'])
+        self._config_sync_period = timedelta(hours=int(config['playlist_sync_period']))
+
+        self._bot = bot
+        self._loop = bot.loop
+        self._jobs = database.job.JobInterface(bot.loop, config)
+        self._playlists = database.playlist.PlaylistInterface(bot.loop, config, bot.extractor)
+
+        self._queued = collections.OrderedDict()  # maps job id -> ImportJob, in the order of submission
+        self._running = dict()  # maps job id -> (ImportJob, asyncio.Task)
+        self._messages = dict()  # maps job id -> discord.Message with the progress
+        self._wakeup = asyncio.Event(loop=bot.loop)
+
+    def stats(self):
+        return {'queued': len(self._queued), 'running': len(self._running), 'cap': self._config_job_limit}
+
+    async def submit(self, user_id, playlist_name, prepend, uris):
+        job = await self._jobs.create(user_id, playlist_name, prepend, list(uris))
+        await self._report(job, '**Import [#{}] to** {} **was queued**, {} item(s) to process'
+                           .format(job.id, job.playlist, len(uris)))
+        self._queued[job.id] = job
+        self._wakeup.set()
+        return job.id
+
+    async def sync(self, user_id, playlist_name=None, *, lane='interactive'):
+        # returns the playlist name and the number of songs to be imported
+        playlist_name, urls = await self._playlists.sync(user_id, playlist_name, lane=lane)
+        if urls:
+            if await self._has_job(user_id, playlist_name):
+                raise RuntimeError('Songs are being imported to the playlist {} already, please synchronize it after '
+                                   'the import is finished'.format(playlist_name))
+            await self.submit(user_id, playlist_name, False, urls)
+        return playlist_name, len(urls)
+
+    async def get_jobs(self, user_id):
+        jobs = await self._jobs.get_user_jobs(user_id)
+        return [(job, 'running' if job.id in self._running else 'queued', len(json.loads(job.uris))) for job in jobs]
+
+    async def cancel(self, user_id, job_id=None):
+        jobs = await self._jobs.get_user_jobs(user_id)
+        if job_id is not None:
+            jobs = [job for job in jobs if job.id == job_id]
+            if not jobs:
+                raise ValueError('You don\'t have an import with the ID {}'.format(job_id))
+
+        for job in jobs:
+            self._queued.pop(job.id, None)
+            running = self._running.pop(job.id, None)
+            if running is not None:
+                running[1].cancel()
+            await self._jobs.delete(job.id)
+            await self._report(job, '**Import [#{}] to** {} **was cancelled**'.format(job.id, job.playlist))
+            self._messages.pop(job.id, None)
+
+        self._wakeup.set()
+        return len(jobs)
+
+    async def task_import(self):
+        await self._bot.wait_for_initialization()
+        try:
+            # jobs submitted in the meantime are kept, the queue is ordered by the job ids
+            for job in await self._jobs.get_pending():
+                self._queued.setdefault(job.id, job)
+            self._queued = collections.OrderedDict(sorted(self._queued.items()))
+            if self._queued:
+                log.info('{} unfinished playlist import(s) will be resumed'.format(len(self._queued)))
+
+            while True:
+                self._dispatch()
+                await self._wakeup.wait()
+                self._wakeup.clear()
+        finally:
+            # jobs are persisted, they will continue after the restart
+            for job, task in self._running.values():
+                task.cancel()
+            self._running.clear()
+
+    async def task_sync(self):
+        if not self._config_sync_period:
+            return
+        await self._bot.wait_for_initialization()
+        while True:
+            for user_id, playlist_name in await self._playlists.get_stale_sources(datetime.now() -
+                                                                                   self._config_sync_period):
+                if await self._has_job(user_id, playlist_name):
+                    continue
+                try:
+                    playlist_name, count = await self.sync(user_id, playlist_name, lane='background')
+                except Exception as e:
+                    # most likely the remote list is not available anymore, it is tried again in the next period
+                    log.warning('Synchronization of the playlist {} of the user {} failed: {}'
+                                .format(playlist_name, user_id, e))
+                    continue
+                if count:
+                    log.info('{} song(s) will be imported to the playlist {} of the user {} from its source'
+                             .format(count, playlist_name, user_id))
+            await asyncio.sleep(self._sync_check_interval, loop=self._loop)
+
+    async def _has_job(self, user_id, playlist_name):
+        return any(job.playlist == playlist_name for job in await self._jobs.get_user_jobs(user_id))
+
+    def _dispatch(self):
+        busy_users = {job.user for job, task in self._running.values()}
+        for job_id, job in list(self._queued.items()):
+            if len(self._running) >= self._config_job_limit:
+                return
+            if job.user in busy_users:
+                continue
+            del self._queued[job_id]
+            busy_users.add(job.user)
+            self._running[job_id] = (job, self._loop.create_task(self._run(job)))
+
+    async def _run(self, job):
+        inserted, failed, messages = job.inserted, job.failed, json.loads(job.messages)
+        last_report = 0.0
+        last_checkpoint = time.monotonic()
+        unsaved = 0
+
+        async def progress(remaining, run_inserted, run_failed, run_messages):
+            # remaining input is rewritten by every checkpoint, so it is not done after each item -- items processed
+            # after the last checkpoint are processed again when resumed, which is safe thanks to the duplicate check
+            nonlocal last_report, last_checkpoint, unsaved
+            unsaved += 1
+            if unsaved >= self._checkpoint_items or \
+                    time.monotonic() - last_checkpoint >= self._config_progress_interval:
+                await self._jobs.update(job.id, remaining(), inserted + run_inserted, failed + run_failed,
+                                        messages + run_messages)
+                last_checkpoint = time.monotonic()
+                unsaved = 0
+            if time.monotonic() - last_report >= self._config_progress_interval:
+                last_report = time.monotonic()
+                await self._report(job, '**Import [#{}] to** {} **in progress:** {} song(s) inserted, {} failed, {} '
+                                   'item(s) remaining'.format(job.id, job.playlist, inserted + run_inserted,
+                                                              failed + run_failed, len(remaining())))
+
+        try:
+            await self._report(job, '**Import [#{}] to** {} **has started**'.format(job.id, job.playlist))
+            try:
+                playlist_name, run_inserted, run_failed, truncated, run_messages = \
+                    await self._playlists.insert(job.user, job.playlist, job.prepend, json.loads(job.uris),
+                                                 progress=progress)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the playlist was removed in the meantime
+                playlist_name, run_inserted, run_failed, truncated, run_messages = job.playlist, 0, 0, True, [str(e)]
+
+            inserted += run_inserted
+            failed += run_failed
+            messages += run_messages
+            reply = '**Import [#{}] finished, {} song(s) inserted to** {}\n{} insertion(s) failed' \
+                .format(job.id, inserted, playlist_name, failed)
+            limit = self._jobs.message_limit
+            if messages:
+                reply += '\n **>** ' + '\n **>** '.join(messages[:limit])
+            if len(messages) > limit:
+                reply += '\n **>** ... (more messages suppressed)'
+            if truncated:
+                reply += '\n__**Inserting was cancelled before processing the whole input.**__'
+
+            await self._jobs.delete(job.id)
+            await self._report(job, reply)
+            self._messages.pop(job.id, None)
+        except asyncio.CancelledError:
+            # either cancelled by the user or the bot is shutting down, the job row is handled by the caller
+            raise
+        except Exception:
+            log.exception('Playlist import [#{}] failed unexpectedly'.format(job.id))
+            await self._jobs.delete(job.id)
+        finally:
+            running = self._running.get(job.id)
+            if running is not None and running[0] is job:
+                del self._running[job.id]
+            self._wakeup.set()
+
+    async def _report(self, job, text):
+        # progress of every job is reported in a single message, a new one is sent after the restart
+        message = self._messages.get(job.id)
+        try:
+            if message is not None:
+                self._messages[job.id] = await self._bot.client.edit_message(message, text)
+                return
+            coroutine = self._bot.whisper_id(job.user, text)
+            if coroutine is not None:
+                self._messages[job.id] = await coroutine
+        except discord.HTTPException:
+            log.warning('Progress of the playlist import [#{}] could not be reported'.format(job.id))
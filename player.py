@@ -3,7 +3,6 @@ import asyncio
 import enum
 import errno
 import fcntl
-import functools
 import logging
 import os
 import shlex
@@ -16,7 +15,8 @@ from math import ceil
 import discord.utils
 import youtube_dl
 
-from database.player import UnavailableSongError, PlayerInterface
+from database.common import ServiceUnavailableError
+from database.player import NoEligibleSongError, UnavailableSongError, PlayerInterface
 
 # set up the logger
 log = logging.getLogger('ddmbot.player')
@@ -190,9 +190,6 @@ class Player:
         self._switch_state = asyncio.Event(loop=bot.loop)
         self._auto_transition_task = None
 
-        self._ytdl = youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'format': 'bestaudio/best', 'quiet': True,
-                                           'no_color': True})
-
         # state variables
         self._status_protection_count = 0
         self._apply_cooldown = True
@@ -201,6 +198,10 @@ class Player:
         self._stream_title = None
         self._status_message = None
         self._ffmpeg = None
+        # version of the last listeners and DJ queue update applied
+        self._users_version = 0
+        # maps DJ -> playlist state the DJ was notified about having no eligible song in (or the service outage)
+        self._ineligible_notified = dict()
 
         # create PCM thread
         self._pcm_thread = PcmProcessor(self._bot, self._playback_ended_callback)
@@ -209,7 +210,7 @@ class Player:
             bot.voice.encoder.channels, shlex.quote(bot.config['ddmbot']['pcm_pipe']))
 
         # database interface
-        self._database = PlayerInterface(bot.loop, bot.config['ddmbot'])
+        self._database = PlayerInterface(bot.loop, bot.config['ddmbot'], bot.extractor)
 
     #
     # Resource management wrappers
@@ -357,9 +358,13 @@ class Player:
     #
     # UserManager interface
     #
-    async def users_changed(self, listeners, djs_present):
+    async def users_changed(self, listeners, djs_present, version):
         # we will need a transition lock in any case
         async with self._transition_lock:
+            # notifications are coalesced by the user manager, older ones may arrive late
+            if version <= self._users_version:
+                return
+            self._users_version = version
             if self.stopped:
                 # nobody cares about users
                 return
@@ -473,26 +478,36 @@ class Player:
             try:
                 song = await self._database.get_next_song(dj)
             except LookupError:  # no more songs in DJ's playlist
+                self._ineligible_notified.pop(dj, None)
                 await self._bot.users.leave_queue(dj)
                 await self._bot.whisper_id(dj, 'Your playlist is empty. Please add more songs and rejoin the DJ queue.')
                 return None
-            except RuntimeError as e:  # there was a problem playing the song
-                await self._bot.message('<@{}>, song skipped: {}'.format(dj, str(e)))
-                continue
+            except NoEligibleSongError as e:  # DJ stays in the queue, songs will become eligible eventually
+                # DJ is tried on every song transition, but notified only once until the playlist changes
+                if self._ineligible_notified.get(dj) != e.state:
+                    self._ineligible_notified[dj] = e.state
+                    await self._bot.whisper_id(dj, str(e))
+                return None
             except UnavailableSongError as e:
                 await self._bot.log('Song [{}] *{}* was flagged due to a download error'
                                     .format(e.song_id, e.song_title))
                 await self._bot.message('<@{}>, song skipped: {}'.format(dj, str(e)))
                 continue
+            except ServiceUnavailableError as e:  # outage is not blamed on the DJ, the song is kept for the next try
+                if self._ineligible_notified.get(dj) != 'unavailable':
+                    self._ineligible_notified[dj] = 'unavailable'
+                    await self._bot.whisper_id(dj, 'Your next song cannot be played right now and will be tried again '
+                                                   'later: {}'.format(e))
+                return None
+            self._ineligible_notified.pop(dj, None)
             return song
         await self._bot.users.leave_queue(dj)
         await self._bot.whisper_id(dj, 'Please try to fix your playlist and rejoin the queue')
         return None
 
     async def _get_stream_info(self):
-        func = functools.partial(self._ytdl.extract_info, self._stream_url, download=False)
         try:
-            info = await self._bot.loop.run_in_executor(None, func)
+            info = await self._database.get_stream_info(self._stream_url)
         except youtube_dl.DownloadError as e:
             await self._bot.message('Failed to obtain stream information: {}'.format(str(e)))
             return False
@@ -587,8 +602,14 @@ class Player:
 
                 # try to get a next dj and a song
                 dj = await self._bot.users.get_next_dj()
+                tried_djs = set()
 
                 while dj is not None:
+                    # DJs with nothing eligible to play stay in the queue, each one is tried once per transition
+                    if dj in tried_djs:
+                        dj = None
+                        break
+                    tried_djs.add(dj)
                     # we have a potential candidate for a dj, but nothing is certain at this point
                     # we will try to get a playable song, 3 times, then moving on to the next dj
                     self._song_context = await self._get_song(dj)
@@ -610,6 +631,9 @@ class Player:
                         await self._bot.log('Song [{}] *{}* was flagged due to a download error'
                                             .format(e.song_id, e.song_title))
                         continue
+                    except ServiceUnavailableError:
+                        # service has just become unavailable, its songs are not picked from now on
+                        continue
 
                     if self._song_context is None:
                         # if we did not succeed with automatic playlist, we're... eh doomed?
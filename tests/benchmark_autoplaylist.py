@@ -0,0 +1,106 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+from datetime import datetime, timedelta
+
+import peewee
+
+import database.common
+from database.common import Song
+
+
+#
+# Benchmark of the automatic playlist selection on a synthetic catalog
+#
+# Compares the original selection (filtering the whole song table with ORDER BY RANDOM() on every pick) with loading
+# the in-memory pool at the startup and picking from it. Then the pool is reloaded in a thread (as the consistency check
+# does) while it is notified about the song changes, measuring how long the notifications wait. Catalog resembles a real
+# one -- most of the songs pass the listener threshold, some were played recently or ran out of credits, a few are
+# blacklisted, failed or duplicates.
+#
+# Usage: python -m tests.benchmark_autoplaylist [--songs N] [--picks N]
+#
+def _populate(songs):
+    now = datetime.now()
+    epoch = database.common._credits.epoch()
+    rows = list()
+    for number in range(1, songs + 1):
+        listener_count = random.randint(0, 30)
+        rows.append(('yt:{}'.format(number), 'Song {}'.format(number), random.randint(60, 900),
+                     random.random() < 0.01, now - timedelta(hours=random.randint(0, 24 * 60)),
+                     random.randint(0, 3), epoch, listener_count, random.randint(0, listener_count // 2),
+                     random.random() < 0.02, random.randint(1, number - 1) if number > 1 and random.random() < 0.01
+                     else None))
+    database.common._database.get_conn().executemany(
+        'INSERT INTO "song" ("uuri", "title", "duration", "is_blacklisted", "last_played", "credit_count", '
+        '"credit_epoch", "listener_count", "skip_vote_count", "has_failed", "duplicate_id") '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', rows)
+    database.common._database.commit()
+    database.common._database.execute_sql('ANALYZE;')
+
+
+def _original_pick(threshold, ratio, max_duration, interval):
+    # selection as done before the pool was introduced
+    return Song.select(Song).where(
+        Song.last_played < datetime.now() - timedelta(seconds=interval),
+        Song.listener_count >= threshold,
+        Song.skip_vote_count < peewee.Passthrough(ratio) * Song.listener_count,
+        Song.duration <= max_duration,
+        database.common._credits.expression() > 0,
+        ~Song.is_blacklisted,
+        ~Song.has_failed,
+        Song.duplicate >> None
+    ).order_by(peewee.fn.Random()).get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Automatic playlist selection benchmark')
+    parser.add_argument('--songs', type=int, default=1000000, help='size of the synthetic catalog')
+    parser.add_argument('--picks', type=int, default=20, help='number of the original selections measured')
+    args = parser.parse_args()
+    threshold, ratio, max_duration, interval = 5, 0.5, 600, 3 * 3600
+
+    directory = tempfile.mkdtemp()
+    try:
+        database.common.initialize(os.path.join(directory, 'ddmbot.db'), 1, 'balanced')
+        database.common._credits.configure(3, timedelta(hours=24))
+        start = time.perf_counter()
+        _populate(args.songs)
+        print('Catalog of {} songs created in {:.1f} s'.format(args.songs, time.perf_counter() - start))
+
+        original = timeit.timeit(lambda: _original_pick(threshold, ratio, max_duration, interval),
+                                 number=args.picks) / args.picks
+        print('Original selection:  {:10.3f} ms per pick'.format(original * 1000))
+
+        pool = database.common.AutoplaylistPool()
+        pool.configure(threshold, ratio, max_duration, interval, True)
+        start = time.perf_counter()
+        pool.load()
+        print('Pool load (startup): {:10.3f} ms, {} active, {} cooling, {} exhausted'
+              .format((time.perf_counter() - start) * 1000, *pool.size))
+        picks = args.picks * 1000
+        print('Pool selection:      {:10.3f} ms per pick'.format(timeit.timeit(pool.pick, number=picks) / picks * 1000))
+
+        # reload is run by a reader in the bot, changes notified by the database worker must not wait for it
+        latencies = list()
+        loader = threading.Thread(target=pool.load, kwargs={'reload': True})
+        loader.start()
+        while loader.is_alive():
+            start = time.perf_counter()
+            pool.refresh([random.randint(1, args.songs)])
+            latencies.append(time.perf_counter() - start)
+        loader.join()
+        print('Pool reload:         {:10.3f} ms longest of {} refresh() calls made meanwhile'
+              .format(max(latencies) * 1000, len(latencies)))
+    finally:
+        database.common.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
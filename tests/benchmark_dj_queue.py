@@ -0,0 +1,78 @@
+import argparse
+import collections
+import timeit
+
+from usermanager import DjQueue
+
+
+#
+# Micro-benchmark of the DJ queue operations
+#
+# Compares the DjQueue with the collections.deque it replaced, on the operations done by the user manager -- leaving
+# and rejoining the queue (a DJ from the middle), membership tests, taking a snapshot and the rotation after a song is
+# played. Snapshots are also measured right after a rotation (the status update follows every one) and after a rejoin,
+# then the whole status update path -- rotation, snapshot and the set of DJs built from it by the player.
+#
+# Usage: python -m tests.benchmark_dj_queue [--djs N] [--repeat N]
+#
+def _deque_operations(djs):
+    queue = collections.deque(range(djs))
+    middle = djs // 2
+
+    def rejoin():
+        queue.remove(middle)
+        queue.append(middle)
+
+    def rotate_snapshot():
+        queue.rotate(-1)
+        return list(queue)
+
+    def rejoin_snapshot():
+        rejoin()
+        return list(queue)
+
+    return {'remove + append': rejoin, 'membership test': lambda: middle in queue, 'snapshot': lambda: list(queue),
+            'rotate': lambda: queue.rotate(-1), 'rotate + snapshot': rotate_snapshot,
+            'rejoin + snapshot': rejoin_snapshot, 'rotate + status': lambda: set(rotate_snapshot())}
+
+
+def _dj_queue_operations(djs):
+    queue = DjQueue()
+    for discord_id in range(djs):
+        queue.append(discord_id)
+    middle = djs // 2
+
+    def rejoin():
+        queue.remove(middle)
+        queue.append(middle)
+
+    def rotate_snapshot():
+        queue.rotate()
+        return queue.snapshot()
+
+    def rejoin_snapshot():
+        rejoin()
+        return queue.snapshot()
+
+    return {'remove + append': rejoin, 'membership test': lambda: middle in queue, 'snapshot': queue.snapshot,
+            'rotate': queue.rotate, 'rotate + snapshot': rotate_snapshot, 'rejoin + snapshot': rejoin_snapshot,
+            'rotate + status': lambda: set(rotate_snapshot())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DJ queue micro-benchmark')
+    parser.add_argument('--djs', type=int, default=5000, help='number of the queued DJs')
+    parser.add_argument('--repeat', type=int, default=10000, help='number of the calls measured')
+    args = parser.parse_args()
+
+    deque_operations = _deque_operations(args.djs)
+    dj_queue_operations = _dj_queue_operations(args.djs)
+    print('{} queued DJs, time per call:'.format(args.djs))
+    for name in deque_operations:
+        results = [min(timeit.repeat(operations[name], number=args.repeat, repeat=3)) / args.repeat * 1000000
+                   for operations in (deque_operations, dj_queue_operations)]
+        print('  {:22} deque {:9.2f} us   DjQueue {:9.2f} us'.format(name, *results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import asyncio
+import configparser
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import database.common
+import database.player
+import database.playlist
+import database.song
+from database.common import Link, Playlist, Song, User
+
+
+#
+# Regression tests of the query plans of the hot queries
+#
+# The partial indexes are only used when the query conditions imply the index condition, which silently stops working
+# once a condition is bound as a parameter instead. Plans are checked on an analyzed database resembling a real one,
+# most of the songs are originals and only a few of them have failed.
+#
+# Playlist queries are not rebuilt here, statements executed by the interfaces are recorded instead and their plans are
+# checked afterwards.
+#
+class QueryPlanTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._directory = tempfile.mkdtemp()
+        database.common.initialize(os.path.join(cls._directory, 'ddmbot.db'), 1, 'balanced')
+        db = database.common._database
+        with db.atomic():
+            for number in range(2000):
+                Song.insert(uuri='yt:{}'.format(number), title='Song {}'.format(number), duration=200,
+                            last_played=datetime(2000, 1, 1), credit_count=3, listener_count=number % 7,
+                            skip_vote_count=0, is_blacklisted=number % 300 == 0, has_failed=number % 100 == 0,
+                            duplicate=1 if number and number % 50 == 0 else None).execute()
+            # every user has a playlist of 30 songs, the first song of the second user is blacklisted
+            for user_id in range(1, 51):
+                User.insert(id=user_id).execute()
+                playlist_id = Playlist.insert(user=user_id, name='default', repeat=user_id == 3).execute()
+                song_ids = [user_id * 30 + number + 2 for number in range(30)]
+                if user_id == 2:
+                    song_ids[0] = 301
+                link_ids = [Link.insert(playlist=playlist_id, song=song_id).execute() for song_id in song_ids]
+                for link_id, next_id in zip(link_ids, link_ids[1:]):
+                    Link.update(next=next_id).where(Link.id == link_id).execute()
+                Playlist.update(head=link_ids[0]).where(Playlist.id == playlist_id).execute()
+                User.update(active_playlist=playlist_id).where(User.id == user_id).execute()
+        db.execute_sql('ANALYZE;')
+        cls._statements = cls._record_statements()
+
+    @staticmethod
+    def _record_statements():
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.ini'))
+        loop = asyncio.new_event_loop()
+        playlists = database.playlist.PlaylistInterface(loop, config['ddmbot'], None)
+        player = database.player.PlayerInterface(loop, config['ddmbot'], None)
+
+        db = database.common._database
+        statements = list()
+        execute_sql = db.execute_sql
+
+        def recording_execute_sql(sql, params=None, require_commit=True):
+            statements.append((sql, params))
+            return execute_sql(sql, params, require_commit)
+
+        db.execute_sql = recording_execute_sql
+        try:
+            # append (duplicate check, tail lookup) and prepend of a song present (predecessor lookup)
+            loop.run_until_complete(playlists.insert(1, None, False, ['1900', '40']))
+            loop.run_until_complete(playlists.insert(1, None, True, ['45']))
+            loop.run_until_complete(playlists.pop_id(1, 50, None))
+            loop.run_until_complete(playlists.show(1, 0, 10, None))
+            # second link is played (predecessor lookup), repeated playlist is rotated (tail lookup)
+            for user_id in (2, 3):
+                link_id, song = loop.run_until_complete(player._get_next_link(user_id))
+                loop.run_until_complete(player._consume_link(link_id))
+        finally:
+            del db.execute_sql
+            loop.close()
+        return statements
+
+    @classmethod
+    def tearDownClass(cls):
+        database.common.close()
+        shutil.rmtree(cls._directory)
+
+    @staticmethod
+    def _plan(query):
+        sql, params = query.sql()
+        return ' '.join(QueryPlanTest._plan_details(sql, params))
+
+    @staticmethod
+    def _plan_details(sql, params):
+        return [row[-1] for row in database.common._database.execute_sql('EXPLAIN QUERY PLAN ' + sql,
+                                                                         params).fetchall()]
+
+    def _recorded(self, *fragments):
+        statements = [(sql, params) for sql, params in self._statements if all(part in sql for part in fragments)]
+        self.assertTrue(statements, 'No statement containing {} was executed'.format(fragments))
+        return statements
+
+    def _assert_index(self, index, *fragments):
+        for sql, params in self._recorded(*fragments):
+            self.assertIn('INDEX ' + index, ' '.join(self._plan_details(sql, params)), sql)
+
+    def test_autoplaylist_pool(self):
+        pool = database.common.AutoplaylistPool()
+        pool.configure(2, 0.5, 600, 3600, False)
+        self.assertIn('USING INDEX song_autoplaylist', self._plan(pool._candidates()))
+
+    def test_failed_songs(self):
+        self.assertIn('INDEX song_has_failed_duplicate_id',
+                      self._plan(database.song.SongInterface._failed_query()))
+
+    def test_duplicate_check(self):
+        self._assert_index('link_playlist_id_song_id', '"link"', '."playlist_id" = ?', '."song_id" = ?')
+
+    def test_tail_lookup(self):
+        self._assert_index('link_playlist_id_next_id', '"link"', '."playlist_id" = ?', '."next_id" IS ?')
+
+    def test_predecessor_lookup(self):
+        # covered by the index peewee creates for the foreign key
+        self._assert_index('link_next_id', '"link"', '."next_id" = ?')
+
+    def test_playlist_walks(self):
+        # links and songs are looked up by their primary keys in every step, only the CTE itself is scanned
+        statements = self._recorded('WITH RECURSIVE')
+        self.assertEqual(len(statements), 3)
+        for sql, params in statements:
+            for detail in self._plan_details(sql, params):
+                if detail.startswith('SCAN'):
+                    self.assertIn('cte', detail, sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
 import collections
+import collections.abc
+import heapq
+import itertools
 import logging
 import string
 import random
-import datetime
+import time
 import asyncio
 from contextlib import suppress
 
@@ -16,13 +19,13 @@ class ListenerInfo:
     __slots__ = ['_last_activity', '_is_direct', 'notified_dj', 'notified_ds']
 
     def __init__(self, *, direct):
-        self._last_activity = datetime.datetime.now()
+        self._last_activity = time.monotonic()
         self._is_direct = direct
         self.notified_dj = False
         self.notified_ds = False
 
     def refresh(self):
-        self._last_activity = datetime.datetime.now()
+        self._last_activity = time.monotonic()
         self.notified_dj = False
         self.notified_ds = False
 
@@ -35,14 +38,165 @@ class ListenerInfo:
         return self._is_direct
 
 
+#
+# Timeout deadlines ordered in a heap, using the monotonic clock
+#
+# Deadlines are identified by their kind and a key (token or discord id). Moving a deadline to a later time does not
+# touch the heap, the entry is pushed back with the new time once it pops out. Only the expired entries are processed.
+#
+class DeadlineHeap:
+    def __init__(self):
+        self._heap = list()
+        self._deadlines = dict()  # maps (kind, key) -> deadline
+        self._scheduled = dict()  # maps (kind, key) -> time of the earliest heap entry
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def arm(self, kind, key, deadline):
+        # returns True if the new deadline is the first one to expire
+        identifier = (kind, key)
+        self._deadlines[identifier] = deadline
+        scheduled = self._scheduled.get(identifier)
+        if scheduled is not None and scheduled <= deadline:
+            return False
+        self._scheduled[identifier] = deadline
+        heapq.heappush(self._heap, (deadline, kind, key))
+        return self._heap[0] == (deadline, kind, key)
+
+    def disarm(self, kind, key):
+        # heap entry is left in place, it is skipped once it pops out
+        self._deadlines.pop((kind, key), None)
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now):
+        # generator, deadlines disarmed by the caller while iterating are skipped
+        while self._heap and self._heap[0][0] <= now:
+            scheduled, kind, key = heapq.heappop(self._heap)
+            identifier = (kind, key)
+            # entry superseded by an earlier one
+            if self._scheduled.get(identifier) != scheduled:
+                continue
+            del self._scheduled[identifier]
+
+            deadline = self._deadlines.get(identifier)
+            if deadline is None:
+                continue
+            if deadline > now:
+                self._scheduled[identifier] = deadline
+                heapq.heappush(self._heap, (deadline, kind, key))
+                continue
+            del self._deadlines[identifier]
+            yield kind, key
+
+
+#
+# Read-only view of the DJ queue at the time it was taken
+#
+# It refers to the tuple cached by the DjQueue and an offset into it, so the views taken after a rotation are created
+# without copying the queue.
+#
+class DjQueueView(collections.abc.Sequence):
+    __slots__ = ['_members', '_offset']
+
+    def __init__(self, members, offset):
+        self._members = members
+        self._offset = offset
+
+    def __len__(self):
+        return len(self._members)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if not -len(self._members) <= index < len(self._members):
+            raise IndexError('DJ queue index out of range')
+        return self._members[(index + self._offset) % len(self._members)]
+
+    def __iter__(self):
+        if not self._offset:
+            return iter(self._members)
+        return itertools.chain(self._members[self._offset:], self._members[:self._offset])
+
+
+#
+# DJ queue with constant time membership tests, removals and rotation
+#
+# Order is kept by an OrderedDict (a hash map with a linked list). Its members are cached as a tuple until the
+# membership changes, rotation only moves the offset of the first DJ in it. Snapshots are views of the cached tuple, so
+# the status updates (done right after every rotation) do not copy the queue.
+#
+class DjQueue:
+    def __init__(self):
+        self._order = collections.OrderedDict()
+        self._members = ()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, discord_id):
+        return discord_id in self._order
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def snapshot(self):
+        if self._members is None:
+            self._members = tuple(self._order)
+            self._offset = 0
+        return DjQueueView(self._members, self._offset)
+
+    def append(self, discord_id):
+        self._order[discord_id] = None
+        self._order.move_to_end(discord_id)
+        self._members = None
+
+    def insert(self, index, discord_id):
+        # linear, but used by the operators only
+        self._order.pop(discord_id, None)
+        tail = list(self._order)[index:]
+        self._order[discord_id] = None
+        for item in tail:
+            self._order.move_to_end(item)
+        self._members = None
+
+    def remove(self, discord_id):
+        try:
+            del self._order[discord_id]
+        except KeyError as e:
+            raise ValueError('{} is not in the queue'.format(discord_id)) from e
+        self._members = None
+
+    def rotate(self):
+        # moves the first item to the end and returns it, the queue must not be empty
+        discord_id = next(iter(self._order))
+        self._order.move_to_end(discord_id)
+        if self._members is not None:
+            self._offset = (self._offset + 1) % len(self._members)
+        return discord_id
+
+    def clear(self):
+        self._order.clear()
+        self._members = ()
+        self._offset = 0
+
+
 class UserManager:
+    # window in which the changes of the listeners and the DJ queue are coalesced into a single player update [seconds]
+    _notify_delay = 0.5
+
     def __init__(self, bot):
         config = bot.config['ddmbot']
-        self._config_ds_token_timeout = datetime.timedelta(seconds=int(config['ds_token_timeout']))
-        self._config_ds_notify_time = datetime.timedelta(seconds=int(config['ds_notify_time']))
-        self._config_ds_remove_time = datetime.timedelta(seconds=int(config['ds_remove_time']))
-        self._config_dj_notify_time = datetime.timedelta(seconds=int(config['dj_notify_time']))
-        self._config_dj_remove_time = datetime.timedelta(seconds=int(config['dj_remove_time']))
+        self._config_ds_token_timeout = int(config['ds_token_timeout'])
+        self._config_ds_notify_time = int(config['ds_notify_time'])
+        self._config_ds_remove_time = int(config['ds_remove_time'])
+        self._config_dj_notify_time = int(config['dj_notify_time'])
+        self._config_dj_remove_time = int(config['dj_remove_time'])
+        self._activity_timeouts = {'dj_notify': self._config_dj_notify_time, 'dj_remove': self._config_dj_remove_time,
+                                   'ds_notify': self._config_ds_notify_time, 'ds_remove': self._config_ds_remove_time}
 
         self._bot = bot
 
@@ -50,7 +204,15 @@ class UserManager:
 
         self._tokens = dict()  # maps token (string) -> (timestamp, user)
         self._listeners = dict()  # maps discord_id (int) -> ListenerInfo
-        self._queue = collections.deque()
+        self._queue = DjQueue()
+
+        # timeouts of the tokens, DJs and direct listeners
+        self._deadlines = DeadlineHeap()
+        self._deadlines_changed = asyncio.Event(loop=bot.loop)
+
+        # pending player notification, every change increments the version
+        self._version = 0
+        self._notify_handle = None
 
     #
     # API for displaying information
@@ -58,7 +220,7 @@ class UserManager:
     async def get_display_info(self):
         async with self._lock:
             direct_listeners = {key for key, value in self._listeners.items() if value.is_direct}
-            return len(self._listeners), direct_listeners, list(self._queue)
+            return len(self._listeners), direct_listeners, self._queue.snapshot()
 
     def is_listening(self, discord_id):
         return discord_id in self._listeners
@@ -90,12 +252,12 @@ class UserManager:
         async with self._lock:
             if not self._queue:
                 return None
-            discord_id = self._queue.popleft()
-            self._queue.append(discord_id)
-            return discord_id
+            return self._queue.rotate()
 
     async def clear_queue(self):
         async with self._lock:
+            for discord_id in self._queue:
+                self._disarm_dj(discord_id)
             self._queue.clear()
 
     #
@@ -130,8 +292,14 @@ class UserManager:
 
             # now add the user to the listeners, rewriting previous entry if present
             self._listeners[discord_id] = ListenerInfo(direct=direct)
+            if direct:
+                self._arm_ds(discord_id)
+            else:
+                self._disarm_ds(discord_id)
+            if discord_id in self._queue:
+                self._arm_dj(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def remove_listener(self, discord_id, *, direct):
         async with self._lock:
@@ -146,8 +314,10 @@ class UserManager:
                 self._queue.remove(discord_id)
             # remove the user from the listeners
             self._listeners.pop(discord_id)
+            self._disarm_dj(discord_id)
+            self._disarm_ds(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def join_queue(self, discord_id):
         async with self._lock:
@@ -156,8 +326,9 @@ class UserManager:
             if discord_id in self._queue:
                 return
             self._queue.append(discord_id)
+            self._arm_dj(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def leave_queue(self, discord_id):
         async with self._lock:
@@ -165,8 +336,9 @@ class UserManager:
                 self._queue.remove(discord_id)
             except ValueError as e:
                 raise ValueError('You are not in the DJ queue') from e
+            self._disarm_dj(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def move_listener(self, discord_id, position):
         if position < 1:
@@ -180,31 +352,48 @@ class UserManager:
                 self._queue.remove(discord_id)
                 inserted = False
             self._queue.insert(position - 1, discord_id)
+            self._arm_dj(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
             return inserted, min(len(self._queue), position)
 
     async def generate_token(self, discord_id):
         # limit time spent in the critical section -- get the time and generate the token in advance
-        current_time = datetime.datetime.now()
+        current_time = time.monotonic()
         token = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(64))
         async with self._lock:
             # key collisions are possible, but should be negligible
             log.debug('Added token {} for user {}'.format(token, discord_id))
             self._tokens[token] = (current_time, discord_id)
+            self._arm('token', token, current_time + self._config_ds_token_timeout)
             return token
 
+    #
+    # Player notifications
+    #
+    def _users_changed(self):
+        # player is notified at the end of the window started by the first change, with the state at that time
+        self._version += 1
+        if self._notify_handle is None:
+            self._notify_handle = self._bot.loop.call_later(self._notify_delay, self._notify_player)
+
+    def _notify_player(self):
+        self._notify_handle = None
+        self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue),
+                                                                  self._version))
+
     #
     # API for activity update
     #
-    async def refresh_activity(self, discord_id):
-        async with self._lock:
-            if discord_id in self._listeners:
-                log.debug('Refreshing activity for user {}'.format(discord_id))
-                info = self._listeners[discord_id]
-                if info.notified_dj or info.notified_ds:
-                    self._whisper(discord_id, 'Your inactivity timer has been reset successfully')
-                info.refresh()
+    def refresh_activity(self, discord_id):
+        # called for every message the bot can see, so the lock is not taken and the deadlines are not touched
+        # the activity stamps are read lazily once the deadlines expire, see _deadline_expired
+        info = self._listeners.get(discord_id)
+        if info is None:
+            return
+        if info.notified_dj or info.notified_ds:
+            self._whisper(discord_id, 'Your inactivity timer has been reset successfully')
+        info.refresh()
 
     #
     # Internal timeout checking task
@@ -212,60 +401,85 @@ class UserManager:
     def _whisper(self, user_id, message):
         self._bot.loop.create_task(self._bot.whisper_id(user_id, message))
 
+    def _arm(self, kind, key, deadline):
+        if self._deadlines.arm(kind, key, deadline):
+            self._deadlines_changed.set()
+
+    def _arm_dj(self, discord_id):
+        last_activity = self._listeners[discord_id].last_activity
+        self._arm('dj_notify', discord_id, last_activity + self._config_dj_notify_time)
+        self._arm('dj_remove', discord_id, last_activity + self._config_dj_remove_time)
+
+    def _disarm_dj(self, discord_id):
+        self._deadlines.disarm('dj_notify', discord_id)
+        self._deadlines.disarm('dj_remove', discord_id)
+
+    def _arm_ds(self, discord_id):
+        last_activity = self._listeners[discord_id].last_activity
+        self._arm('ds_notify', discord_id, last_activity + self._config_ds_notify_time)
+        self._arm('ds_remove', discord_id, last_activity + self._config_ds_remove_time)
+
+    def _disarm_ds(self, discord_id):
+        self._deadlines.disarm('ds_notify', discord_id)
+        self._deadlines.disarm('ds_remove', discord_id)
+
     async def task_check_timeouts(self):
         while True:
-            await asyncio.sleep(20, loop=self._bot.loop)
-            current_time = datetime.datetime.now()
-            # sets used to store users and tokens to remove
-            remove_tokens = set()
-            remove_djs = set()
-            remove_listeners = set()
+            # sleep until the first deadline, or until an earlier one is armed
+            deadline = self._deadlines.next_deadline()
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._deadlines_changed.wait(), timeout, loop=self._bot.loop)
+            self._deadlines_changed.clear()
+
+            users_changed = False
             async with self._lock:
-                # check all tokens
-                for token, (created, user) in self._tokens.items():
-                    if current_time - created > self._config_ds_token_timeout:
-                        remove_tokens.add(token)
-                # check all djs
-                for dj in self._queue:
-                    info = self._listeners[dj]
-                    time_diff = current_time - info.last_activity
-                    if time_diff > self._config_dj_remove_time:
-                        self._whisper(dj, 'You have been removed from the DJ queue due to inactivity')
-                        remove_djs.add(dj)
-                    elif time_diff > self._config_dj_notify_time and not info.notified_dj:
-                        log.info('DJ {} notified for being inactive'.format(dj))
-                        self._whisper(dj, 'You\'re about to be removed from the DJ queue due to inactivity.\n'
-                                          'Please reply to this message to prevent that.')
-                        info.notified_dj = True
-                # and all the direct listeners too
-                for listener, info in self._listeners.items():
-                    if not info.is_direct:
-                        continue
-                    time_diff = current_time - info.last_activity
-                    if time_diff > self._config_ds_remove_time:
-                        self._whisper(listener, 'You have been disconnected from the stream due to inactivity')
-                        remove_listeners.add(listener)
-                    elif time_diff > self._config_ds_notify_time and not info.notified_ds:
-                        log.info('Listener {} notified for being inactive'.format(listener))
-                        self._whisper(listener, 'You\'re about to be disconnected from the stream due to inactivity.\n'
-                                                'Please reply to this message to prevent that.')
-                        info.notified_ds = True
-
-                # now it is save to edit lists / dictionaries
-                for token in remove_tokens:
-                    log.info('Token {} has timed out'.format(token))
-                    self._tokens.pop(token)
-                for dj in remove_djs:
-                    log.info('DJ {} has timed out'.format(dj))
-                    self._queue.remove(dj)
-                for listener in remove_listeners:
-                    log.info('Listener {} has timed out'.format(listener))
-                    self._bot.loop.create_task(self._bot.stream.disconnect(listener))
-                    with suppress(ValueError):
-                        self._queue.remove(listener)
-                    self._listeners.pop(listener)
+                for kind, key in self._deadlines.pop_expired(time.monotonic()):
+                    users_changed |= self._deadline_expired(kind, key)
 
             # now update the player
-            if remove_listeners or remove_djs:
-                self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()),
-                                                                          bool(self._queue)))
+            if users_changed:
+                self._users_changed()
+
+    def _deadline_expired(self, kind, key):
+        # must be called with the lock held, returns True if the listeners or the DJ queue were changed
+        if kind in self._activity_timeouts:
+            deadline = self._listeners[key].last_activity + self._activity_timeouts[kind]
+            if deadline > time.monotonic():
+                # activity was refreshed in the meantime, the deadlines are armed again from the new stamp
+                if kind.startswith('dj'):
+                    self._arm_dj(key)
+                else:
+                    self._arm_ds(key)
+                return False
+
+        if kind == 'token':
+            log.info('Token {} has timed out'.format(key))
+            self._tokens.pop(key, None)
+        elif kind == 'dj_notify':
+            log.info('DJ {} notified for being inactive'.format(key))
+            self._whisper(key, 'You\'re about to be removed from the DJ queue due to inactivity.\n'
+                               'Please reply to this message to prevent that.')
+            self._listeners[key].notified_dj = True
+        elif kind == 'dj_remove':
+            log.info('DJ {} has timed out'.format(key))
+            self._whisper(key, 'You have been removed from the DJ queue due to inactivity')
+            self._queue.remove(key)
+            self._deadlines.disarm('dj_notify', key)
+            return True
+        elif kind == 'ds_notify':
+            log.info('Listener {} notified for being inactive'.format(key))
+            self._whisper(key, 'You\'re about to be disconnected from the stream due to inactivity.\n'
+                               'Please reply to this message to prevent that.')
+            self._listeners[key].notified_ds = True
+        elif kind == 'ds_remove':
+            log.info('Listener {} has timed out'.format(key))
+            self._whisper(key, 'You have been disconnected from the stream due to inactivity')
+            self._bot.loop.create_task(self._bot.stream.disconnect(key))
+            with suppress(ValueError):
+                self._queue.remove(key)
+            self._listeners.pop(key)
+            self._disarm_dj(key)
+            self._deadlines.disarm('ds_notify', key)
+            return True
+        return False